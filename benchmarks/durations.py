@@ -0,0 +1,48 @@
+"""
+Compares the fast path of utils.durations to dateparser on the kind of inputs given to /register.
+
+Usage: ``python -m benchmarks.durations [rounds]``
+"""
+import sys
+import time
+
+from utils import durations
+
+CORPUS = [
+    "1 semaine", "2 semaines", "1 mois", "3 mois", "6 mois", "1 an", "30 jours", "7 jours", "15 jours",
+    "une semaine", "un mois", "1 mois et 2 jours", "10 avril 2022", "1er mai 2023", "31 décembre 2024",
+    "15 août", "10/04/2023", "01/09/2024", "2024-06-30", "Un An",
+]
+
+
+def bench(name, function, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for value in CORPUS:
+            function(value)
+    elapsed = time.perf_counter() - start
+    per_call = elapsed / (rounds * len(CORPUS))
+    print(f"{name:<28} {per_call * 1e6:>10.1f} µs/call   {1 / per_call:>12.0f} calls/s")
+    return per_call
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    start = time.perf_counter()
+    durations.warm_up()
+    print(f"dateparser import + warm up: {(time.perf_counter() - start) * 1000:.0f} ms\n")
+
+    misses = [value for value in CORPUS if durations.parse_fast(value) is None]
+    if misses:
+        print(f"Not handled by the fast path: {misses}\n")
+
+    slow = bench("dateparser", durations.parse_slow, rounds)
+    durations.compile_value.cache_clear()
+    cold = bench("fast path (first round cold)", durations.parse, 1)
+    warm = bench("fast path (cached)", durations.parse, rounds * 50)
+    print(f"\nSpeedup: x{slow / cold:.0f} cold, x{slow / warm:.0f} cached")
+
+
+if __name__ == "__main__":
+    main()
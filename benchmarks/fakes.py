@@ -0,0 +1,495 @@
+"""
+Offline stand-ins for Discord and Postgres, good enough to drive the bot's code paths without network.
+
+- :class:`FakePool` mimics an ``asyncpg.Pool`` and answers the bot's queries from in-memory tables,
+  with a configurable latency per round trip. It is meant to be wrapped by the real ``DatabasePool``.
+- :class:`FakeHTTP` records the role calls made through ``bot.http`` with a configurable latency.
+- :class:`FakeBot`, :class:`FakeInteraction`, :class:`FakeMember`... carry just what the cogs, modals and
+  command tree use.
+"""
+import asyncio
+import bisect
+import datetime
+import itertools
+import re
+import time
+import types
+
+from utils.blacklist import BlacklistCache
+from utils.database import DatabasePool, Query
+from utils.members import MemberResolver
+from utils.metrics import Metrics
+from utils.outbox import Outbox
+from utils.ratelimit import RateLimiter
+from utils.roles import RoleMutator
+from utils.tree import CustomCommandTree
+
+# Importing these registers every fixed query of the bot.
+import utils.expiry  # noqa
+import utils.modals  # noqa
+import utils.outbox  # noqa
+import utils.subscriptions  # noqa
+
+PREMIUM_GUILD_ID = 957989755184881764
+PREMIUM_ROLE_ID = 957993239816839208
+# Sorts after every transaction id, to bisect on (expire_at, transaction) pairs.
+LAST = "\U0010ffff"
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class Record(dict):
+    """Rows are returned as dicts, which support the ``row["column"]`` access the bot relies on."""
+
+
+class Tables:
+    def __init__(self):
+        self.subscribe: dict[str, dict] = {}
+        self.registered_user: dict[int, dict] = {}
+        # Sorted (expire_at, transaction) of the claimed rows, stands in for the partial index on expire_at.
+        self.expire_index: list[tuple[datetime.datetime, str]] = []
+        self.dm_outbox: dict[int, dict] = {}
+        self.dm_keys: set[str] = set()
+        self.dm_sequence = itertools.count(1)
+
+    def _index(self, row):
+        if row["user_id"] is not None and row["expire_at"] is not None:
+            bisect.insort(self.expire_index, (row["expire_at"], row["transaction"]))
+
+    def _unindex(self, row):
+        if row["user_id"] is not None and row["expire_at"] is not None:
+            key = (row["expire_at"], row["transaction"])
+            index = bisect.bisect_left(self.expire_index, key)
+            if index < len(self.expire_index) and self.expire_index[index] == key:
+                del self.expire_index[index]
+
+    def upsert(self, transaction, **values):
+        row = self.subscribe.get(transaction)
+        if row is None:
+            row = self.subscribe[transaction] = dict(transaction=transaction, user_id=None, approved=False,
+                                                     registered_at=None, claimed_at=None, expire_at=None)
+        else:
+            self._unindex(row)
+        row.update(values)
+        self._index(row)
+        return row
+
+    def delete(self, transaction):
+        row = self.subscribe.pop(transaction)
+        self._unindex(row)
+        return row
+
+    def populate(self, size: int, *, claimed_ratio: float = 0.8, expired: int = 0):
+        """Fills ``subscribe`` with ``size`` approved rows, ``expired`` of them already expired."""
+        now = utcnow()
+        self.expire_index.clear()
+        for i in range(size):
+            claimed = i < expired or i % 100 < claimed_ratio * 100
+            expire_at = now - datetime.timedelta(minutes=1 + i) if i < expired else \
+                now + datetime.timedelta(days=1 + i % 365, seconds=i)
+            self.subscribe[f"TX{i:08d}"] = dict(
+                transaction=f"TX{i:08d}", user_id=10_000 + i if claimed else None, approved=True,
+                registered_at=now - datetime.timedelta(days=30), claimed_at=now if claimed else None,
+                expire_at=expire_at)
+        self.expire_index = sorted((r["expire_at"], r["transaction"]) for r in self.subscribe.values()
+                                   if r["user_id"] is not None and r["expire_at"] is not None)
+
+
+class FakeConnection:
+    TERMINATE = re.compile(r"DELETE FROM subscribe WHERE (.+) RETURNING\s+\*")
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.tables = pool.tables
+        self._handlers = {query.sql: getattr(self, f"_{query.name}") for query in Query.registry.values()
+                          if hasattr(self, f"_{query.name}")}
+
+    # asyncpg API
+
+    async def _round_trip(self, sql, args):
+        self.pool.round_trips += 1
+        if self.pool.latency:
+            await asyncio.sleep(self.pool.latency)
+        handler = self._handlers.get(sql)
+        if handler is not None:
+            return handler(*args)
+        if match := self.TERMINATE.fullmatch(sql.strip()):
+            return self._terminate(match.group(1), args)
+        if sql.lstrip().upper().startswith(("CREATE", "DROP")):
+            return []
+        if sql == "SELECT id, reason FROM registered_user WHERE is_blacklisted":
+            return [Record(id=r["id"], reason=r["reason"]) for r in self.tables.registered_user.values()
+                    if r["is_blacklisted"]]
+        raise NotImplementedError(f"FakeConnection doesn't know how to run: {sql}")
+
+    async def fetch(self, sql, *args, **kwargs):
+        return await self._round_trip(sql, args) or []
+
+    async def fetchrow(self, sql, *args, **kwargs):
+        rows = await self._round_trip(sql, args)
+        return rows[0] if rows else None
+
+    async def fetchval(self, sql, *args, **kwargs):
+        row = await self.fetchrow(sql, *args)
+        return next(iter(row.values())) if row else None
+
+    async def execute(self, sql, *args, **kwargs):
+        await self._round_trip(sql, args)
+        return "OK"
+
+    async def executemany(self, sql, args, **kwargs):
+        self.pool.round_trips += 1
+        for arg in args:
+            self._handlers[sql](*arg)
+
+    # Queries
+
+    def _claim_subscription(self, user_id, name, transaction):
+        now = utcnow()
+        self.tables.registered_user.setdefault(user_id, dict(id=user_id, is_blacklisted=False, reason=None))
+        row = self.tables.subscribe.get(transaction)
+        if row is None:
+            self.tables.upsert(transaction, user_id=user_id, approved=False, registered_at=now)
+            return [Record(status="pending", expire_at=None)]
+        if row["user_id"] is not None and row["user_id"] != user_id:
+            return [Record(status="taken", expire_at=row["expire_at"])]
+        if not row["approved"] or row["expire_at"] is None:
+            return [Record(status="pending", expire_at=row["expire_at"])]
+        if row["user_id"] is None or row["claimed_at"] is None:
+            row = self.tables.upsert(transaction, user_id=user_id, claimed_at=now,
+                                     expire_at=now + (row["expire_at"] - row["registered_at"]))
+        return [Record(status="claimed", expire_at=row["expire_at"])]
+
+    def _register_transactions(self, transactions, expirations):
+        now = utcnow()
+        rows = []
+        for transaction, expire_at in zip(transactions, expirations):
+            existing = self.tables.subscribe.get(transaction)
+            bound = existing is not None and existing["user_id"] is not None
+            row = self.tables.upsert(transaction, approved=True, expire_at=expire_at,
+                                     **({"claimed_at": now} if bound else {"registered_at": now, "claimed_at": None}))
+            rows.append(Record(transaction=transaction, user_id=row["user_id"], expire_at=expire_at))
+        return rows
+
+    def _unbind_transactions(self, transactions):
+        for transaction in transactions:
+            if transaction in self.tables.subscribe:
+                self.tables.upsert(transaction, user_id=None, claimed_at=None)
+
+    def _fetch_upcoming_expirations(self, horizon, limit):
+        index = self.tables.expire_index
+        end = min(bisect.bisect_right(index, (horizon, LAST)), limit)
+        return [Record(transaction=t, expire_at=e) for e, t in index[:end]]
+
+    def _delete_expired_subscriptions(self, now):
+        index = self.tables.expire_index
+        end = bisect.bisect_right(index, (now, LAST))
+        rows = [self.tables.subscribe[t] for _, t in index[:end]]
+        for row in rows:
+            self.tables.delete(row["transaction"])
+        return [Record(transaction=r["transaction"], user_id=r["user_id"]) for r in rows]
+
+    def _enqueue_dms(self, user_ids, contents, keys, send_after):
+        now = utcnow()
+        for user_id, content, key, after in zip(user_ids, contents, keys, send_after):
+            if key is not None:
+                if key in self.tables.dm_keys:
+                    continue
+                self.tables.dm_keys.add(key)
+            row_id = next(self.tables.dm_sequence)
+            self.tables.dm_outbox[row_id] = dict(id=row_id, user_id=user_id, content=content,
+                                                 send_after=after or now, attempts=0, last_error=None, sent_at=None)
+
+    def _claim_dms(self, limit, lease, max_attempts):
+        now = utcnow()
+        due = sorted((r for r in self.tables.dm_outbox.values()
+                      if r["sent_at"] is None and r["send_after"] <= now and r["attempts"] < max_attempts),
+                     key=lambda r: r["send_after"])[:limit]
+        for row in due:
+            row.update(send_after=now + lease, attempts=row["attempts"] + 1)
+        return [Record(id=r["id"], user_id=r["user_id"], content=r["content"], attempts=r["attempts"]) for r in due]
+
+    def _mark_dms_sent(self, ids):
+        for row_id in ids:
+            self.tables.dm_outbox[row_id].update(sent_at=utcnow(), last_error=None)
+
+    def _mark_dms_failed(self, ids, errors, give_up, max_attempts):
+        for row_id, error, drop in zip(ids, errors, give_up):
+            row = self.tables.dm_outbox[row_id]
+            delay = datetime.timedelta(seconds=min(60 * 2 ** (row["attempts"] - 1), 21600))
+            row.update(last_error=error, attempts=max_attempts if drop else row["attempts"],
+                       send_after=utcnow() + delay)
+
+    def _purge_sent_dms(self, retention):
+        limit = utcnow() - retention
+        for row_id in [i for i, r in self.tables.dm_outbox.items() if r["sent_at"] and r["sent_at"] < limit]:
+            del self.tables.dm_outbox[row_id]
+
+    def _fetch_blacklist_reason(self, user_id):
+        row = self.tables.registered_user.get(user_id)
+        if row and row["is_blacklisted"]:
+            return [Record(reason=row["reason"] or "No reason provided")]
+        return []
+
+    def _terminate(self, condition, args):
+        # Only the filters /terminate builds: "transaction=$1", "user_id=$n", joined by AND or OR.
+        filters = dict(re.findall(r"(\w+)=\$(\d+)", condition))
+        values = {column: args[int(position) - 1] for column, position in filters.items()}
+        combine = any if " OR " in condition else all
+        if "transaction" in values and combine is all:
+            row = self.tables.subscribe.get(values["transaction"])
+            candidates = [row] if row else []
+        else:
+            candidates = list(self.tables.subscribe.values())
+        matches = [r for r in candidates if combine(r[c] == v for c, v in values.items())]
+        return [Record(self.tables.delete(r["transaction"])) for r in matches]
+
+    # Used by BlacklistCache
+
+    def add_termination_listener(self, callback):
+        pass
+
+    async def add_listener(self, channel, callback):
+        pass
+
+    async def remove_listener(self, channel, callback):
+        pass
+
+    def is_closed(self):
+        return False
+
+
+class FakePool:
+    """Quacks like an ``asyncpg.Pool`` of ``size`` connections."""
+
+    def __init__(self, tables: Tables = None, *, latency: float = 0.0, size: int = 10):
+        self.tables = tables or Tables()
+        self.latency = latency
+        self.round_trips = 0
+        self._size = size
+        self._idle = asyncio.Queue()
+        for _ in range(size):
+            self._idle.put_nowait(FakeConnection(self))
+
+    async def acquire(self):
+        return await self._idle.get()
+
+    async def release(self, connection):
+        self._idle.put_nowait(connection)
+
+    def get_size(self):
+        return self._size
+
+    def get_idle_size(self):
+        return self._idle.qsize()
+
+    def get_min_size(self):
+        return self._size
+
+    def get_max_size(self):
+        return self._size
+
+    async def close(self):
+        pass
+
+
+class FakeHTTP:
+    """Records the role calls, each one taking ``latency`` seconds, at most ``concurrency`` at once."""
+
+    def __init__(self, *, latency: float = 0.0, concurrency: int = 50):
+        self.latency = latency
+        self.calls: list[tuple] = []
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def _call(self, *call):
+        async with self._semaphore:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            self.calls.append(call)
+
+    async def add_role(self, guild_id, user_id, role_id, *, reason=None):
+        await self._call("add_role", guild_id, user_id, role_id)
+
+    async def remove_role(self, guild_id, user_id, role_id, *, reason=None):
+        await self._call("remove_role", guild_id, user_id, role_id)
+
+
+class FakeRole:
+    def __init__(self, guild):
+        self.id = PREMIUM_ROLE_ID
+        self.guild = guild
+
+    def __str__(self):
+        return "Premium"
+
+
+class FakeMember:
+    def __init__(self, member_id: int, guild=None, http: FakeHTTP = None):
+        self.id = member_id
+        self.name = f"member{member_id}"
+        self.guild = guild
+        self._http = http
+        self.dms: list[str] = []
+
+    def __str__(self):
+        return self.name
+
+    async def send(self, content=None, **kwargs):
+        if self._http is not None:
+            await self._http._call("send_dm", self.id)
+        self.dms.append(content)
+
+
+class FakeGuild:
+    def __init__(self, member_ids, http: FakeHTTP):
+        self.id = PREMIUM_GUILD_ID
+        self._http = http
+        self._members = {i: FakeMember(i, self, http) for i in member_ids}
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+    async def fetch_member(self, member_id):
+        await self._http._call("fetch_member", member_id)
+        member = self._members.get(member_id)
+        if member is None:
+            raise _not_found()
+        return member
+
+
+def _not_found():
+    import discord
+    response = types.SimpleNamespace(status=404, reason="Not Found")
+    return discord.NotFound(response, {"message": "Unknown Member", "code": 10007})
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self._interaction = interaction
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def defer(self, **kwargs):
+        self._done = True
+        self._interaction.acknowledged_at = time.perf_counter()
+
+    async def send_message(self, content=None, **kwargs):
+        self._done = True
+        self._interaction.acknowledged_at = time.perf_counter()
+        self._interaction.messages.append(content if content is not None else kwargs.get("embed"))
+
+    async def send_modal(self, modal):
+        self._done = True
+        self._interaction.acknowledged_at = time.perf_counter()
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self._interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        self._interaction.messages.append(content if content is not None else kwargs.get("embed"))
+
+
+class FakeInteraction:
+    def __init__(self, client, user: FakeMember, *, command=None):
+        self.client = client
+        self.user = user
+        self.guild = None
+        self.channel = None
+        self.command = command
+        self.extras = {}
+        self.messages = []
+        self.created_at = time.perf_counter()
+        self.acknowledged_at = None
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+
+class FakeBot:
+    """Wires the real subsystems (database wrapper, blacklist cache, role queue, metrics) to the fakes."""
+
+    def __init__(self, *, tables: Tables = None, member_ids=(), db_latency: float = 0.0,
+                 http_latency: float = 0.0, pool_size: int = 10):
+        import discord
+
+        self.loop = asyncio.get_running_loop()
+        self.colour = discord.Colour(value=0xA37FFF)
+        self.http = FakeHTTP(latency=http_latency)
+        self.fake_pool = FakePool(tables, latency=db_latency, size=pool_size)
+        self.pool = DatabasePool(self.fake_pool)
+        self.blacklist = BlacklistCache(self.pool)
+        self.role_mutator = RoleMutator(self)
+        self.members = MemberResolver()
+        self.metrics = Metrics(self)
+        self.outbox = Outbox(self)
+        # No limits by default, the scenarios would measure the throttling instead of the code path.
+        self.rate_limiter = RateLimiter()
+        self.latencies = []
+        self.server_object = FakeGuild(member_ids, self.http)
+        self.server_premium_role = FakeRole(self.server_object)
+        self.premium_exempt_ids = set()
+        self.expiry_scheduler = None
+        self.default_checks = {self.check_blacklisted}
+        self.background_tasks: set[asyncio.Task] = set()
+        self.last_task: asyncio.Task = None
+        self.tree = types.SimpleNamespace(on_error=self.on_tree_error)
+        self.errors: list[BaseException] = []
+        self._ready = asyncio.Event()
+        self._ready.set()
+
+    @property
+    def tables(self) -> Tables:
+        return self.fake_pool.tables
+
+    async def start(self):
+        await self.blacklist.load()
+        self.role_mutator.start()
+
+    async def close(self):
+        await self.role_mutator.stop()
+        self.outbox.stop()
+
+    # Same behaviour as AkbBot, which can't be imported without the private config.
+
+    def create_background_task(self, coro):
+        task = self.loop.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        # BaseModal.on_submit doesn't yield after creating its task, so this is always the caller's.
+        self.last_task = task
+        return task
+
+    async def drain_background_tasks(self):
+        while self.background_tasks:
+            await asyncio.gather(*self.background_tasks)
+
+    @staticmethod
+    async def check_blacklisted(interaction):
+        return not await interaction.client.blacklist.get(interaction.user.id)
+
+    def record_command(self, interaction, command, status):
+        self.metrics.inc("akb_commands_total", status=status)
+
+    async def on_tree_error(self, interaction, command, error):
+        self.errors.append(error)
+
+    def get_user(self, user_id):
+        return self.server_object.get_member(user_id)
+
+    async def wait_until_ready(self):
+        await self._ready.wait()
+
+    def is_closed(self):
+        return False
+
+    async def interaction_check(self, interaction):
+        return await CustomCommandTree.interaction_check(None, interaction)  # noqa
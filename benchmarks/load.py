@@ -0,0 +1,225 @@
+"""
+Offline load test of the hot paths, driven through the fakes in benchmarks.fakes.
+
+Usage: ``python -m benchmarks.load [--sizes 1000,100000] [--requests 2000] [--concurrency 100]
+[--db-latency 2] [--http-latency 50]`` (latencies in milliseconds).
+
+For every scenario and table size it reports the throughput, the p50/p99 latency and the number of
+database round trips and Discord HTTP calls per command.
+"""
+import argparse
+import asyncio
+import datetime
+import random
+import time
+
+from discord import app_commands
+
+from benchmarks.fakes import FakeBot, FakeInteraction, FakeMember, Tables
+from cogs.insitute import Institute
+from utils.expiry import ExpiryScheduler
+from utils.modals import RegisterModal, SubscribeModal
+from utils.ratelimit import RateLimiter
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Scenario:
+    def __init__(self, name, bot, requests, concurrency, units=None):
+        self.name = name
+        self.bot = bot
+        self.requests = requests
+        self.concurrency = concurrency
+        # What the throughput and per-op counts are relative to, the requests by default.
+        self.units = units or requests
+        self.latencies = []
+        self.ack_latencies = []
+
+    async def run(self, operation):
+        """
+        Runs ``operation(i)`` ``requests`` times, ``concurrency`` at a time, recording each latency. If the
+        operation returns its interaction, the time it took to acknowledge it is recorded too.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        round_trips, http_calls = self.bot.fake_pool.round_trips, len(self.bot.http.calls)
+
+        async def one(i):
+            async with semaphore:
+                start = time.perf_counter()
+                interaction = await operation(i)
+                self.latencies.append(time.perf_counter() - start)
+                if interaction is not None and interaction.acknowledged_at is not None:
+                    self.ack_latencies.append(interaction.acknowledged_at - interaction.created_at)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(self.requests)))
+        await self.bot.drain_background_tasks()
+        elapsed = time.perf_counter() - start
+        self.report(elapsed, self.bot.fake_pool.round_trips - round_trips, len(self.bot.http.calls) - http_calls)
+
+    def report(self, elapsed, round_trips, http_calls):
+        ack = f"   ack p99 {percentile(self.ack_latencies, 0.99) * 1000:>7.2f} ms" if self.ack_latencies else ""
+        print(f"  {self.name:<22} {self.units / elapsed:>9.0f} op/s"
+              f"   p50 {percentile(self.latencies, 0.5) * 1000:>8.2f} ms"
+              f"   p99 {percentile(self.latencies, 0.99) * 1000:>8.2f} ms"
+              f"   {round_trips / self.units:>5.2f} db/op   {http_calls / self.units:>5.2f} http/op{ack}")
+
+
+async def make_bot(args, size, *, expired=0):
+    tables = Tables()
+    tables.populate(size, expired=expired)
+    member_ids = [r["user_id"] for r in tables.subscribe.values() if r["user_id"] is not None]
+    bot = FakeBot(tables=tables, member_ids=member_ids, db_latency=args.db_latency / 1000,
+                  http_latency=args.http_latency / 1000)
+    await bot.start()
+    return bot
+
+
+async def interaction_check(args, size):
+    bot = await make_bot(args, size)
+    users = [FakeMember(random.randrange(10_000, 10_000 + size)) for _ in range(args.requests)]
+
+    async def check(i):
+        await bot.interaction_check(FakeInteraction(bot, users[i]))
+
+    await Scenario("interaction_check", bot, args.requests, args.concurrency).run(check)
+    await bot.close()
+
+
+async def rate_limiter(args, size):
+    bot = await make_bot(args, size)
+    # Tight enough that most hits past the first few are throttled, over as many users as the table has rows.
+    bot.rate_limiter = RateLimiter({"subscribe": (3, 60)}, {"subscribe": (1000, 1)}, max_buckets=size)
+    users = [random.randrange(size) for _ in range(args.requests * 10)]
+    scenario = Scenario("rate limiter (per hit)", bot, 1, 1, units=len(users))
+
+    async def hits(_):
+        for user_id in users:
+            try:
+                bot.rate_limiter.hit("subscribe", user_id)
+            except app_commands.CommandOnCooldown:
+                pass
+
+    await scenario.run(hits)
+    assert len(bot.rate_limiter.buckets) <= size
+    await bot.close()
+
+
+async def subscribe(args, size):
+    bot = await make_bot(args, size)
+    scenario = Scenario("SubscribeModal", bot, args.requests, args.concurrency)
+
+    async def submit(i):
+        # A third claims an approved transaction, a third tries someone else's, a third is a new one.
+        transaction = f"TX{random.randrange(size):08d}" if i % 3 != 2 else f"NEW{i:08d}"
+        row = bot.tables.subscribe.get(transaction)
+        user_id = row["user_id"] if row and row["user_id"] and i % 3 == 0 else 5_000_000 + i
+        interaction = FakeInteraction(bot, FakeMember(user_id))
+        modal = SubscribeModal()
+        modal.transaction_id._value = transaction
+        await modal.on_submit(interaction)
+        await bot.last_task
+        return interaction
+
+    await scenario.run(submit)
+    await bot.close()
+
+
+async def register(args, size):
+    bot = await make_bot(args, size)
+    scenario = Scenario("RegisterModal", bot, args.requests, args.concurrency)
+
+    async def submit(i):
+        interaction = FakeInteraction(bot, FakeMember(1))
+        modal = RegisterModal()
+        modal.transaction_id._value = f"TX{random.randrange(size):08d}"
+        modal.expire_at._value = random.choice(("1 semaine", "1 mois", "3 mois", "10 avril 2030"))
+        await modal.on_submit(interaction)
+        await bot.last_task
+        return interaction
+
+    await scenario.run(submit)
+    await bot.close()
+
+
+async def terminate(args, size):
+    bot = await make_bot(args, size)
+    cog = Institute(bot)
+    scenario = Scenario("terminate", bot, min(args.requests, size), args.concurrency)
+
+    async def run(i):
+        interaction = FakeInteraction(bot, FakeMember(1))
+        await Institute.terminate.callback(cog, interaction, transaction=f"TX{i:08d}")
+        return interaction
+
+    await scenario.run(run)
+    await bot.close()
+
+
+async def expiry(args, size):
+    expired = min(args.requests, size)
+    bot = await make_bot(args, size, expired=expired)
+    scheduler = ExpiryScheduler(bot)
+    scenario = Scenario("expiry (per row)", bot, 1, 1, units=expired)
+
+    async def cycle(_):
+        await scheduler._refill()
+        await scheduler._expire(datetime.datetime.now(datetime.timezone.utc))
+
+    await scenario.run(cycle)
+    assert len(bot.tables.subscribe) == size - expired
+    await bot.close()
+
+
+async def outbox(args, size):
+    bot = await make_bot(args, size)
+    members = bot.server_object.members
+    # Delivery is paced to outbox.RATE, a few batches are enough.
+    messages = [(members[i % len(members)].id, "Rappel", f"bench:{i}", None) for i in range(min(args.requests, 100))]
+    scenario = Scenario("outbox (per DM)", bot, 1, 1, units=len(messages))
+
+    async def drain(_):
+        await bot.outbox.enqueue(messages)
+        bot.outbox.start()
+        while any(r["sent_at"] is None for r in bot.tables.dm_outbox.values()):
+            await asyncio.sleep(0.05)
+
+    await scenario.run(drain)
+    await bot.close()
+
+
+SCENARIOS = {
+    "interaction_check": interaction_check,
+    "rate_limiter": rate_limiter,
+    "subscribe": subscribe,
+    "register": register,
+    "terminate": terminate,
+    "expiry": expiry,
+    "outbox": outbox,
+}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,100000", help="Comma separated subscribe table sizes")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--db-latency", type=float, default=1.0, help="Per round trip, in milliseconds")
+    parser.add_argument("--http-latency", type=float, default=50.0, help="Per Discord call, in milliseconds")
+    parser.add_argument("--only", choices=SCENARIOS, action="append", help="Only run these scenarios")
+    args = parser.parse_args()
+
+    random.seed(0)
+    for size in map(int, args.sizes.split(",")):
+        print(f"subscribe table: {size} rows, db latency {args.db_latency}ms, http latency {args.http_latency}ms")
+        for name, scenario in SCENARIOS.items():
+            if args.only and name not in args.only:
+                continue
+            await scenario(args, size)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,11 +1,27 @@
+import asyncio
 import datetime
-import pytz
+import logging
+import re
+import tempfile
 from typing import Union, Literal
 
 import discord
 from discord.ext import commands, tasks
 from discord import app_commands
+from utils import durations
+from utils.expiry import ExpiryScheduler
 from utils.modals import SubscribeModal, RegisterModal
+from utils.reconcile import Reconciler
+from utils.subscriptions import (register_transactions, export_subscriptions, enqueue_expiry_reminders,
+                                 terminate_query)
+
+# Maximum size of the file given to /register_batch.
+MAX_BATCH_FILE_SIZE = 1024 * 1024
+
+
+def premium_guild_available(interaction) -> bool:
+    """The premium guild's members and roles are only cached by the cluster that handles it."""
+    return interaction.client.server_object is not None
 
 
 async def setup(bot):
@@ -15,22 +31,136 @@ async def setup(bot):
 class Institute(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.first = True
+        self.expiry = ExpiryScheduler(bot)
+        self.reconciler = Reconciler(bot, bot.premium_exempt_ids)
 
     async def cog_load(self) -> None:
-        self.check_expiration_date.start()
+        # Only the cluster handling the premium guild manages its subscriptions.
+        if self.bot.owns_premium_guild:
+            self.bot.expiry_scheduler = self.expiry
+            self.expiry.start()
+            self.bot.outbox.start()
+            self.reconcile.start()
+            self.remind.start()
+
+    async def cog_unload(self) -> None:
+        self.expiry.stop()
+        self.bot.outbox.stop()
+        self.reconcile.cancel()
+        self.remind.cancel()
+        self.bot.expiry_scheduler = None
+
+    @tasks.loop(hours=6)
+    async def reconcile(self):
+        # tasks.loop only survives connection errors, a database error would stop it for good.
+        try:
+            await self.reconciler.reconcile()
+        except Exception as e:
+            logging.error("Premium role reconciliation failed", exc_info=e)
+
+    @reconcile.before_loop
+    async def before_reconcile(self):
+        await self.bot.wait_until_ready()
+        # Wait for `on_ready_once` to resolve and chunk the premium guild, the role members would be partial.
+        while self.bot.server_premium_role is None or not self.bot.server_object.chunked:
+            await asyncio.sleep(5)
+
+    @tasks.loop(hours=1)
+    async def remind(self):
+        # Looks two periods ahead, a late iteration doesn't skip any reminder.
+        try:
+            await enqueue_expiry_reminders(self.bot, 2 * datetime.timedelta(hours=self.remind.hours))
+        except Exception as e:
+            logging.error("Could not queue the expiry reminders", exc_info=e)
+
+    @remind.before_loop
+    async def before_remind(self):
+        await self.bot.wait_until_ready()
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        if self.bot.server_object is not None and member.guild.id == self.bot.server_object.id:
+            await self.reconciler.reconcile_member(member)
 
     @app_commands.command(name="subscribe", description="Cette commande te permet de procéder à ton inscription.")
     @app_commands.guilds(957989755184881764)
     async def subscribe_(self, interaction):
         await interaction.response.send_modal(SubscribeModal())
 
+    @app_commands.check(premium_guild_available)
     @app_commands.checks.has_permissions(manage_roles=True)
     @app_commands.command(name="register", description="Cette commande permet d'ajouter un nouveau numéro de "
                                                        "transaction dans la base de donnée.")
     async def register_(self, interaction):
         await interaction.response.send_modal(RegisterModal())
 
+    @app_commands.check(premium_guild_available)
+    @app_commands.checks.has_permissions(manage_roles=True)
+    @app_commands.command(name="register_batch", description="Permet d'ajouter plusieurs numéros de transaction à "
+                                                             "partir d'un fichier.")
+    @app_commands.rename(file='fichier')
+    @app_commands.describe(file="Une transaction par ligne : 'numéro de transaction;durée ou date d'éxpiration'")
+    async def register_batch(self, interaction, file: discord.Attachment):
+        if file.size > MAX_BATCH_FILE_SIZE:
+            return await interaction.response.send_message("Ce fichier est trop volumineux.", ephemeral=True)
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        lines = (await file.read()).decode("utf-8-sig").splitlines()
+
+        def parse():
+            entries, invalid = [], []
+            for number, line in enumerate(lines, start=1):
+                if not line.strip():
+                    continue
+                transaction, expiration = (re.split(r"[;,\t]", line, maxsplit=1) + [""])[:2]
+                transaction, expiration = transaction.strip(), expiration.strip()
+                expire_at = durations.parse(expiration) if transaction and expiration else None
+                if expire_at is None:
+                    invalid.append(number)
+                else:
+                    entries.append((transaction.replace(" ", ""), expire_at))
+            return entries, invalid
+
+        entries, invalid = await asyncio.to_thread(parse)
+        result = await register_transactions(self.bot, entries)
+        message = f"{result.registered} abonnement(s) enregistré(s), {len(result.granted)} membre(s) ont reçu leur role."
+        if result.failed:
+            message += f"\nJe n'ai pas pu donner le role à {len(result.failed)} membre(s)."
+        if invalid:
+            message += f"\nLignes ignorées (date d'éxpiration invalide) : {', '.join(map(str, invalid[:50]))}"
+        await interaction.followup.send(message, ephemeral=True)
+
+    @app_commands.checks.has_permissions(manage_roles=True)
+    @app_commands.command(name="export", description="Exporte la liste des abonnements au format CSV.")
+    @app_commands.rename(status='statut', start='depuis', end='jusqua')
+    @app_commands.describe(start="Date d'enregistrement minimale, par exemple '10/04/2022'",
+                           end="Date d'enregistrement maximale (exclue)")
+    async def export(self,
+                     interaction,
+                     status: Literal['en attente', 'non réclamé', 'actif', 'expiré'] = None,
+                     start: str = None,
+                     end: str = None
+                     ):
+        dates = {}
+        for name, value in (("start", start), ("end", end)):
+            if value is not None:
+                # Bounds on past registrations: "1 semaine" means a week ago, "10 avril" the last one.
+                dates[name] = await durations.parse_async(value, past=True)
+                if dates[name] is None:
+                    return await interaction.response.send_message(f"Je n'ai pas pu comprendre la date `{value}`.",
+                                                                   ephemeral=True)
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        with tempfile.TemporaryFile() as file:
+            count = await export_subscriptions(self.bot, file, status=status, **dates)
+            size = file.tell()
+            limit = interaction.guild.filesize_limit if interaction.guild else discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES
+            if size > limit:
+                return await interaction.followup.send(f"L'export ({count} abonnements) est trop volumineux pour être "
+                                                       f"envoyé, merci de le filtrer davantage.", ephemeral=True)
+            file.seek(0)
+            await interaction.followup.send(f"{count} abonnement(s) exporté(s).", ephemeral=True,
+                                            file=discord.File(file, filename="abonnements.csv.gz"))
+
+    @app_commands.check(premium_guild_available)
     @app_commands.checks.has_permissions(manage_roles=True)
     @app_commands.command(name="terminate",
                           description="Permet l'annulation d'abonnement(s) par utilisateur ou par numéro de transaction.")
@@ -45,46 +175,15 @@ class Institute(commands.Cog):
                         ):
         if not user and not transaction:
             return await interaction.response.send_message("Au moins un des deux argument est nécessaire")
-        filters = dict(transaction=transaction, user_id=user.id if user else None)
-        query_list = []
-        query_args = []
-        c = 1
-        for key, val in filters.items():
-            if val is not None:
-                query_list.append(f'{key}=${c}')
-                query_args.append(val)
-                c += 1
-        query = f' {operation} '.join(query_list)
-        query_args = tuple(query_args)
-        info = await interaction.client.pool.fetch(
-            f"DELETE FROM subscribe WHERE {query} RETURNING  *",
-            *query_args)
+        filters = {key: val for key, val in dict(transaction=transaction, user_id=user.id if user else None).items()
+                   if val is not None}
+        # Taking back the roles of a large batch goes way past the interaction's deadline.
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        info = await interaction.client.pool.fetch(terminate_query(filters, operation), *filters.values())
         if not info:
-            return await interaction.response.send_message("Aucun abonnement n'a eté supprimer", ephemeral=True)
-        for row in info:
-            member = self.bot.server_object.get_member(row["user_id"])
-            if member:
-                await member.remove_roles(self.bot.server_premium_role,
-                                          reason=f"Annulation de l'abonnement par {str(interaction.user)}")
+            return await interaction.followup.send("Aucun abonnement n'a eté supprimer", ephemeral=True)
+        members = [m for m in map(self.bot.server_object.get_member, {row["user_id"] for row in info}) if m]
+        await self.bot.role_mutator.remove_roles(members, self.bot.server_premium_role,
+                                                 reason=f"Annulation de l'abonnement par {str(interaction.user)}")
         string = "\n".join([f"""{', '.join(['`' + str(interaction.client.get_user(i["user_id"])) + '`', '`' + i["transaction"] + '`'])}""" for i in info])
-        await interaction.response.send_message(f"J'ai supprimer les abonnements suivant : {string}", ephemeral=True)
-
-    @tasks.loop(minutes=30)
-    async def check_expiration_date(self):
-        if self.first:
-            self.first = False
-            return
-        data = await self.bot.pool.fetch("SELECT transaction,user_id,expire_at FROM subscribe")
-        expired_transactions = []
-        for r in data:
-            if r["user_id"] is not None and r["expire_at"] is not None and r["expire_at"] <= datetime.datetime.utcnow().replace(tzinfo=pytz.UTC):
-                member = self.bot.server_object.get_member(int(r["user_id"]))
-                if member:
-                    try:
-                        await member.remove_roles(self.bot.server_premium_role, reason="Éxpiration de l'abonnement")
-                    except discord.HTTPException:
-                        pass
-                expired_transactions.append((r["transaction"], r["user_id"]))
-        print(len(expired_transactions))
-        await self.bot.pool.executemany("DELETE FROM subscribe WHERE transaction=$1 AND user_id=$2",
-                                        expired_transactions)
+        await interaction.followup.send(f"J'ai supprimer les abonnements suivant : {string}", ephemeral=True)
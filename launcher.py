@@ -0,0 +1,92 @@
+"""
+Runs the bot as several clusters, each cluster being a process handling a contiguous range of shards.
+
+Usage: ``python launcher.py``. The shard count defaults to the one recommended by Discord and can be
+overridden with ``SHARD_COUNT`` in the private config, as well as ``SHARDS_PER_CLUSTER``.
+"""
+import asyncio
+import logging
+import multiprocessing
+import time
+
+import aiohttp
+
+from private import config
+from private.config import TOKEN
+
+from utils import logs
+
+log = logging.getLogger(__name__)
+
+# A cluster that dies more than that many times in a row without staying up for a minute is given up on.
+MAX_RESTARTS = 5
+
+
+async def fetch_recommended_shard_count() -> int:
+    async with aiohttp.ClientSession() as session:
+        async with session.get("https://discord.com/api/v10/gateway/bot",
+                               headers={"Authorization": f"Bot {TOKEN}"}) as resp:
+            resp.raise_for_status()
+            return (await resp.json())["shards"]
+
+
+def run_cluster(cluster_id: int, shard_ids: list[int], shard_count: int):
+    # Imported here so that each process builds its own bot, event loop and connections.
+    from main import AkbBot
+
+    # The listener thread of the parent isn't carried over to the child process.
+    logs.setup_from_config(config, cluster=cluster_id)
+
+    async def main():
+        bot = AkbBot(shard_ids=shard_ids, shard_count=shard_count, cluster_id=cluster_id)
+        async with bot:
+            await bot.start(TOKEN)
+
+    asyncio.run(main())
+
+
+def spawn(cluster_id: int, shard_ids: list[int], shard_count: int) -> multiprocessing.Process:
+    process = multiprocessing.Process(target=run_cluster, args=(cluster_id, shard_ids, shard_count),
+                                      name=f"cluster-{cluster_id}", daemon=True)
+    process.start()
+    logging.info(f"Cluster {cluster_id} started with shards {shard_ids[0]}-{shard_ids[-1]} (pid {process.pid})")
+    return process
+
+
+def main():
+    logs.setup_from_config(config)
+    shard_count = getattr(config, "SHARD_COUNT", None) or asyncio.run(fetch_recommended_shard_count())
+    per_cluster = getattr(config, "SHARDS_PER_CLUSTER", 4)
+    clusters = [list(range(start, min(start + per_cluster, shard_count)))
+                for start in range(0, shard_count, per_cluster)]
+    logging.info(f"Launching {shard_count} shard(s) across {len(clusters)} cluster(s)")
+
+    processes = {}
+    for cluster_id, shard_ids in enumerate(clusters):
+        processes[cluster_id] = (spawn(cluster_id, shard_ids, shard_count), time.monotonic(), 0)
+        # Discord only lets us identify one shard every 5 seconds per bucket, no need to rush the next cluster.
+        time.sleep(5 * len(shard_ids))
+
+    try:
+        while processes:
+            time.sleep(5)
+            for cluster_id, (process, started_at, restarts) in list(processes.items()):
+                if process.is_alive():
+                    continue
+                restarts = 0 if time.monotonic() - started_at > 60 else restarts + 1
+                if restarts > MAX_RESTARTS:
+                    logging.error(f"Cluster {cluster_id} keeps crashing (exit code {process.exitcode}), giving up.")
+                    del processes[cluster_id]
+                    continue
+                logging.warning(f"Cluster {cluster_id} exited with code {process.exitcode}, restarting it.")
+                processes[cluster_id] = (spawn(cluster_id, clusters[cluster_id], shard_count), time.monotonic(),
+                                         restarts)
+    except KeyboardInterrupt:
+        for process, _, _ in processes.values():
+            process.terminate()
+        for process, _, _ in processes.values():
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,13 @@
+import time
+
+# Used to report how long the imports took, must stay above every other import.
+BOOT_STARTED = time.perf_counter()
+
 import asyncio
-import io
 import os
+import sys
 import logging
+import resource
 import contextlib
 import traceback
 
@@ -9,17 +15,27 @@ import aiohttp
 import certifi
 import ssl
 
-import asyncpg
 import discord
 
 from discord.ext import commands
 
+from utils import durations, logs, migrations
+from utils.blacklist import BlacklistCache
+from utils.database import DatabasePool
+from utils.error_reports import ErrorReporter
 from utils.exceptions import UserBlacklisted
+from utils.members import MemberResolver
+from utils.metrics import Metrics
+from utils.outbox import Outbox
+from utils.ratelimit import RateLimiter, DEFAULT_RATE_LIMITS, DEFAULT_GLOBAL_RATE_LIMITS
+from utils.roles import RoleMutator
+from private import config
 from private.config import (TOKEN, DEFAULT_PREFIXES, OWNER_IDS, DB_CONF)
 from utils.tree import CustomCommandTree
 
+IMPORT_DURATION = time.perf_counter() - BOOT_STARTED
+
 log = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO, format="[%(asctime)-15s] %(message)s")
 
 # Some very fancy characters hehe
 err = '\033[41m\033[30m❌\033[0m'
@@ -30,39 +46,87 @@ ok = '\033[42m\033[30m✔\033[0m'
 os.environ['JISHAKU_NO_UNDERSCORE'] = 'True'
 os.environ['JISHAKU_HIDE'] = 'True'
 
+PREMIUM_GUILD_ID = 957989755184881764
+PREMIUM_ROLE_ID = 957993239816839208
+
 
-class AkbBot(commands.Bot):
-    def __init__(self):
+class AkbBot(commands.AutoShardedBot):
+    def __init__(self, *, shard_ids: list[int] = None, shard_count: int = None, cluster_id: int = None,
+                 auto_shard: bool = False):
         # These are all attributes that will be set later in the `on_ready_once` method.
-        self.pool = None
+        self.pool: DatabasePool = None
+        self.blacklist: BlacklistCache = None
         self.invite: str = None
         self.session: aiohttp.ClientSession = None
+        # Set by the Institute cog, used by the modals to schedule freshly claimed subscriptions.
+        self.expiry_scheduler = None
         # All extensions that are not located in the 'cogs' directory.
-        self.initial_extensions = ['jishaku']
-        # Disabling the typing intents as we won't be using them.
-        intents = discord.Intents.all()
-        intents.typing = False  # noqa
-        intents.dm_typing = False  # noqa
+        self.initial_extensions = []
+        # Extensions that aren't needed to serve interactions, loaded in the background once ready.
+        self.deferred_extensions = ['jishaku']
+        # Name -> duration (in seconds) of each startup phase, reported once ready.
+        self.boot_phases: dict[str, float] = {"imports": IMPORT_DURATION}
+        self.started_at = time.monotonic()
+        self.lean_cache = getattr(config, "LEAN_CACHE", True)
+        if self.lean_cache:
+            # Only what the commands (and jishaku's prefix commands) need, members are only cached for the premium
+            # guild, which is chunked in `on_ready_once`, and for members joining afterwards.
+            intents = discord.Intents(guilds=True, members=True, guild_messages=True, dm_messages=True,
+                                      message_content=True)
+            member_cache_flags = discord.MemberCacheFlags.none()
+            member_cache_flags.joined = True
+        else:
+            # Disabling the typing intents as we won't be using them.
+            intents = discord.Intents.all()
+            intents.typing = False  # noqa
+            intents.dm_typing = False  # noqa
+            member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+        # Without a cluster launcher nor auto sharding, we run a single shard like a regular `commands.Bot`.
+        if shard_ids is None and shard_count is None and not auto_shard:
+            shard_ids, shard_count = [0], 1
         super().__init__(
             tree_cls=CustomCommandTree,
             command_prefix=commands.when_mentioned_or(*DEFAULT_PREFIXES),
             strip_after_prefix=True,
-            intents=intents
+            intents=intents,
+            member_cache_flags=member_cache_flags,
+            chunk_guilds_at_startup=not self.lean_cache,
+            shard_ids=shard_ids,
+            shard_count=shard_count,
         )
+        self.cluster_id = cluster_id
         self.help_command = None
         self.server_invite = 'https://discord.gg/vEPEYTztgT'
         self.server_object = None
         self.server_premium_role = None
+        # Members keeping the premium role without a subscription, see `utils.reconcile`.
+        self.premium_exempt_ids = set(getattr(config, "PREMIUM_EXEMPT_IDS", ()))
         self.owner_ids = OWNER_IDS
         self.colour = self.color = discord.Colour(value=0xA37FFF)
         self.default_checks = {self.check_blacklisted}
+        self.role_mutator = RoleMutator(self)
+        self.members = MemberResolver()
+        self.metrics = Metrics(self)
+        # Drained by the cluster handling the premium guild, see the Institute cog.
+        self.outbox = Outbox(self)
+        self.rate_limiter = RateLimiter(getattr(config, "RATE_LIMITS", DEFAULT_RATE_LIMITS),
+                                        getattr(config, "GLOBAL_RATE_LIMITS", DEFAULT_GLOBAL_RATE_LIMITS))
+        self.error_reporter = ErrorReporter(self, 959467834667319316)
+        # Strong references to the fire-and-forget tasks, so they don't get garbage collected mid-way.
+        self.background_tasks: set[asyncio.Task] = set()
+
+    @property
+    def owns_premium_guild(self) -> bool:
+        """Whether the premium guild is handled by one of this process' shards."""
+        if self.shard_ids is None:
+            return True
+        return (PREMIUM_GUILD_ID >> 22) % self.shard_count in self.shard_ids
 
-    @staticmethod
-    async def send_safe_dm(user, *args, **kwargs):
-        try:
-            await user.send(*args, **kwargs)
-        except discord.Forbidden:
-            pass
+    def create_background_task(self, coro) -> asyncio.Task:
+        task = self.loop.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
 
     @staticmethod
     async def check_blacklisted(interaction):
@@ -74,20 +138,57 @@ class AkbBot(commands.Bot):
         return True
 
     async def is_blacklisted(self, user):
-        return await self.pool.fetchval("SELECT reason FROM registered_user WHERE id=$1 AND is_blacklisted", user.id)
+        return await self.blacklist.get(user.id)
+
+    @contextlib.asynccontextmanager
+    async def boot_phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.boot_phases[name] = time.perf_counter() - start
+
+    async def setup_database(self):
+        async with self.boot_phase("database"):
+            self.pool = await self.establish_database_connection()
+            # The blacklist cache relies on the trigger created by the migrations.
+            applied = await migrations.migrate(self.pool)
+            if applied:
+                logging.info(f"{ok} Database schema migrated to version {applied[-1].version}.")
+            self.blacklist = BlacklistCache(self.pool)
+            await self.blacklist.load()
+
+    async def setup_session(self):
+        async with self.boot_phase("session"):
+            ssl_context = await asyncio.to_thread(ssl.create_default_context, cafile=certifi.where())
+            connector = aiohttp.TCPConnector(ssl=ssl_context)
+            self.session = aiohttp.ClientSession(connector=connector)
 
     async def setup_hook(self) -> None:
-        self.pool = await self.establish_database_connection()
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        connector = aiohttp.TCPConnector(ssl=ssl_context)
-        self.session = aiohttp.ClientSession(connector=connector)
-        await self.load_cogs()
+        async with self.boot_phase("setup_hook"):
+            self.role_mutator.start()
+            self.error_reporter.start()
+            # None of these depend on each other, the cogs only use the pool once the bot is ready.
+            await asyncio.gather(self.setup_database(), self.setup_session(), self.load_cogs())
+            # Opt-in, the metrics aren't worth failing the boot over.
+            metrics_port = getattr(config, "METRICS_PORT", None)
+            if metrics_port:
+                # Every cluster gets its own port.
+                port = metrics_port + (self.cluster_id or 0)
+                try:
+                    await self.metrics.start(getattr(config, "METRICS_HOST", "127.0.0.1"), port)
+                except OSError as e:
+                    logging.error(f"Could not serve the metrics on port {port}, carrying on without them.", exc_info=e)
+        self._setup_finished_at = time.perf_counter()
         self.loop.create_task(self.on_ready_once())
 
     async def on_ready_once(self):
         await self.wait_until_ready()
-        self.server_object = self.get_guild(957989755184881764)
-        self.server_premium_role = self.server_object.get_role(957993239816839208)
+        if self.owns_premium_guild:
+            self.server_object = self.get_guild(PREMIUM_GUILD_ID)
+            self.server_premium_role = self.server_object.get_role(PREMIUM_ROLE_ID)
+            if not self.server_object.chunked:
+                await self.server_object.chunk(cache=True)
         self.invite = discord.utils.oauth_url(self.user.id,
                                               permissions=discord.Permissions(173211516614),
                                               redirect_uri=self.server_invite,
@@ -97,50 +198,73 @@ class AkbBot(commands.Bot):
                 type=discord.ActivityType.watching, name="/subscribe"
             )
         )
+        self.boot_phases["login_to_ready"] = time.perf_counter() - self._setup_finished_at
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        phases = ", ".join(f"{name}={duration * 1000:.0f}ms" for name, duration in self.boot_phases.items())
+        logging.info(f"{ok} Ready in {time.monotonic() - self.started_at:.1f}s, peak RSS {rss:.0f} MiB "
+                     f"({len(self.guilds)} guild(s), {sum(1 for _ in self.get_all_members())} cached member(s), "
+                     f"lean cache {'on' if self.lean_cache else 'off'})")
+        logging.info(f"Boot phases: {phases}")
+        self.create_background_task(self.warm_up())
+
+    async def warm_up(self):
+        """Loads what isn't needed to reach ready: deferred extensions and the date parser."""
+        async with self.boot_phase("warm_up"):
+            await self.load_cogs(self.deferred_extensions)
+            await asyncio.to_thread(durations.warm_up)
+        logging.info(f"{ok} Warm up done in {self.boot_phases['warm_up'] * 1000:.0f}ms")
 
     @staticmethod
-    async def establish_database_connection() -> asyncpg.Pool:
-        credentials = {
-            "user": DB_CONF.user,
-            "password": DB_CONF.password,
-            "database": DB_CONF.db,
-            "host": DB_CONF.host,
-            "port": DB_CONF.port
-        }
-
+    async def establish_database_connection() -> DatabasePool:
         try:
-            return await asyncpg.create_pool(**credentials)
-
+            pool = await DatabasePool.create(DB_CONF)
         except Exception as e:
-            logging.error("Could not create database pool", exc_info=e)
+            logging.error(f"{err} Could not create database pool {err}", exc_info=e)
+            raise
+        logging.info(f'{ok} Database connection created.')
+        return pool
+
+    async def close(self) -> None:
+        await self.metrics.stop()
+        if self.blacklist:
+            await self.blacklist.close()
+        await self.role_mutator.stop()
+        self.outbox.stop()
+        await self.error_reporter.stop()
+        await super().close()
+        if self.pool:
+            await self.pool.close()
+
+    def record_command(self, interaction, command, status: str):
+        """Records the latency of an app command or modal, from the interaction check to completion or error."""
+        if command is not None:
+            name = command.qualified_name
+        else:
+            name = type(interaction.extras["modal"]).__name__ if "modal" in interaction.extras else "unknown"
+        started_at = interaction.extras.get("started_at")
+        if started_at is not None:
+            self.metrics.observe("akb_command_seconds", time.perf_counter() - started_at, command=name)
+        self.metrics.inc("akb_commands_total", command=name, status=status)
+        logging.info(f"Command {name}: {status}",
+                     extra={**logs.interaction_fields(interaction, command), "status": status, "sample": "command"})
 
-        finally:
-            logging.info(f'{ok} Database connection created.')
+    async def on_app_command_completion(self, interaction, command):
+        self.record_command(interaction, command, "ok")
+
+    async def on_member_join(self, member):
+        self.members.invalidate(member.guild.id, member.id)
 
     async def on_ready(self):
-        logging.info(f"\033[42m\033[35m Logged in as {self.user}! \033[0m")
+        cluster = f" (cluster {self.cluster_id}, shards {self.shard_ids})" if self.cluster_id is not None else ""
+        logging.info(f"\033[42m\033[35m Logged in as {self.user}{cluster}! \033[0m")
 
     async def on_error(self, event_method: str, *args, **kwargs) -> None:
         """ Logs uncaught exceptions and sends them to the error log channel in the support guild. """
         traceback_string = traceback.format_exc()
-        for line in traceback_string.split('\n'):
-            logging.info(line)
-
-        await self.wait_until_ready()
-        error_channel = self.get_channel(959467834667319316)
-        to_send = f"```yaml\nAn error occurred in an {event_method} event``````py" \
-                  f"\n{traceback_string}\n```"
-
-        if len(to_send) < 2000:
-            try:
-                await error_channel.send(to_send)
+        logging.error(f"Unhandled exception in {event_method}", exc_info=True, extra={"event": event_method})
 
-            except (discord.Forbidden, discord.HTTPException):
-                await error_channel.send(f"```yaml\nAn error occurred in an {event_method} event``````py",
-                                         file=discord.File(io.StringIO(traceback_string), filename='traceback.py'))
-        else:
-            await error_channel.send(f"```yaml\nAn error occurred in an {event_method} event``````py",
-                                     file=discord.File(io.StringIO(traceback_string), filename='traceback.py'))
+        self.error_reporter.report(sys.exc_info()[1], f"An error occurred in an {event_method} event",
+                                   traceback_string)
 
     @staticmethod
     async def send_interaction_error_message(interaction, *args, **kwargs):
@@ -158,15 +282,14 @@ class AkbBot(commands.Bot):
             embed.add_field(name="Traceback :", value=f"```py\n{type(error).__name__} : {error}```")
             await interaction.client.send_interaction_error_message(interaction, embed=embed, **kwargs)
 
-        error_channel = interaction.client.get_channel(959467834667319316)
-        traceback_string = "".join(traceback.format_exception(etype=None, value=error, tb=error.__traceback__))
+        traceback_string = "".join(traceback.format_exception(type(error), error, error.__traceback__))
 
         if interaction.guild:
             command_data = (
                 f"by: {interaction.user} ({interaction.user.id})"
                 f"\ncommand: {command}"
                 f"\nguild_id: {interaction.guild.id} - channel_id: {interaction.channel.id}"
-                f"\nowner: {interaction.guild.owner.name} ({interaction.guild.owner.id})"
+                f"\nowner: {interaction.guild.owner} ({interaction.guild.owner_id})"
                 f"\nbot admin: {'✅' if interaction.guild.me.guild_permissions.administrator else '❌'} "
                 f"- role pos: {interaction.guild.me.top_role.position}"
             )
@@ -176,52 +299,42 @@ class AkbBot(commands.Bot):
                 f"\nCommand executed in DMs"
             )
 
-        to_send = (
-            f"```yaml\n{command_data}``````py"
-            f"\nCommand {command} raised the following error:"
-            f"\n{traceback_string}\n```"
-        )
+        interaction.client.error_reporter.report(error, f"{command_data}\nCommand {command} raised the following error:",
+                                                 traceback_string)
+        logging.error(f"Command {command} raised an unexpected error", exc_info=error,
+                      extra=logs.interaction_fields(interaction, command))
 
+    async def load_extension_safe(self, ext):
         try:
-            if len(to_send) < 2000:
-                await error_channel.send(to_send)
-            else:
-                file = discord.File(
-                    io.StringIO(traceback_string), filename="traceback.py"
-                )
-                await error_channel.send(
-                    f"```yaml\n{command_data}``````py Command {command} raised the following error:\n```",
-                    file=file,
-                )
-        finally:
-            for line in traceback_string.split("\n"):
-                logging.info(line)
+            await self.load_extension(ext)
+            logging.info(f"{ok} Loaded extension {ext}")
 
-    async def load_cogs(self):
-        """
-        Loads all the extensions in the ./cogs directory.
-        """
-        extensions = [f"cogs.{f[:-3]}" for f in os.listdir("./cogs") if f.endswith(".py")  # 'Cogs' folder
-                      ] + self.initial_extensions  # Initial extensions like jishaku or others that may be elsewhere
-        for ext in extensions:
-            try:
-                await self.load_extension(ext)
-                logging.info(f"{ok} Loaded extension {ext}")
+        except Exception as e:
+            if isinstance(e, commands.ExtensionNotFound):
+                logging.error(f"{oop} Extension {ext} was not found {oop}", exc_info=False)
 
-            except Exception as e:
-                if isinstance(e, commands.ExtensionNotFound):
-                    logging.error(f"{oop} Extension {ext} was not found {oop}", exc_info=False)
+            elif isinstance(e, commands.NoEntryPointError):
+                logging.error(f"{err} Extension {ext} has no setup function {err}", exc_info=False)
 
-                elif isinstance(e, commands.NoEntryPointError):
-                    logging.error(f"{err} Extension {ext} has no setup function {err}", exc_info=False)
+            else:
+                logging.error(f"{err}{err} Failed to load extension {ext} {err}{err}", exc_info=e)
 
-                else:
-                    logging.error(f"{err}{err} Failed to load extension {ext} {err}{err}", exc_info=e)
+    async def load_cogs(self, extensions=None):
+        """
+        Loads all the extensions in the ./cogs directory, or the given ones, concurrently.
+        """
+        async with self.boot_phase("cogs" if extensions is None else "deferred_extensions"):
+            if extensions is None:
+                extensions = [f"cogs.{f[:-3]}" for f in os.listdir("./cogs") if f.endswith(".py")  # 'Cogs' folder
+                              ] + self.initial_extensions  # Initial extensions that may be elsewhere
+            await asyncio.gather(*(self.load_extension_safe(ext) for ext in extensions))
 
 
 if __name__ == "__main__":
+    logs.setup_from_config(config)
+
     async def main():
-        bot = AkbBot()
+        bot = AkbBot(auto_shard=getattr(config, "AUTO_SHARD", False))
         async with bot:
             await bot.start(TOKEN)
 
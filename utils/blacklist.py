@@ -0,0 +1,106 @@
+import asyncio
+import json
+import logging
+
+from utils.database import Query
+
+# Notified by the trigger created in `utils.migrations` on every blacklist change.
+NOTIFY_CHANNEL = "registered_user_blacklist"
+
+FETCH_BLACKLIST_REASON = Query(
+    "fetch_blacklist_reason",
+    "SELECT coalesce(reason, 'No reason provided') FROM registered_user WHERE id=$1 AND is_blacklisted")
+
+LOAD_BLACKLIST = Query("load_blacklist", "SELECT id, reason FROM registered_user WHERE is_blacklisted")
+
+
+class BlacklistCache:
+    """
+    In-memory copy of the blacklisted users, kept up to date through Postgres ``LISTEN/NOTIFY``.
+
+    As long as the listening connection is alive every lookup is answered from memory, if it is lost
+    the cache falls back to the database until it is loaded again.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.entries: dict[int, str] = {}
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._reload_task: asyncio.Task = None
+        self._reason_tasks: set[asyncio.Task] = set()
+
+    @property
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "loaded": self.loaded, "hits": self.hits, "misses": self.misses}
+
+    async def load(self):
+        await self.close()
+        self._connection = await self.pool.acquire()
+        self._connection.add_termination_listener(self._on_termination)
+        # Listen before reading so that no change can slip between the two.
+        await self._connection.add_listener(NOTIFY_CHANNEL, self._on_notification)
+        rows = await self._connection.fetch(LOAD_BLACKLIST.sql)
+        self.entries = {r["id"]: r["reason"] or "No reason provided" for r in rows}
+        self.loaded = True
+        logging.info(f"Loaded {len(self.entries)} blacklisted user(s) in cache.")
+
+    async def close(self):
+        self.loaded = False
+        if self._reload_task is not None and self._reload_task is not asyncio.current_task():
+            self._reload_task.cancel()
+            self._reload_task = None
+        if self._connection is not None:
+            if not self._connection.is_closed():
+                await self._connection.remove_listener(NOTIFY_CHANNEL, self._on_notification)
+            # Even a dead connection holds its pool slot until it's released.
+            await self.pool.release(self._connection)
+        self._connection = None
+
+    def _on_termination(self, connection):
+        logging.warning("Blacklist listener connection lost, falling back to the database.")
+        self.loaded = False
+        # The dead connection is released by `load` before acquiring a new one.
+        if self._reload_task is None or self._reload_task.done():
+            self._reload_task = asyncio.get_running_loop().create_task(self._reload())
+
+    async def _reload(self, delay: float = 5):
+        while not self.loaded:
+            await asyncio.sleep(delay)
+            try:
+                await self.load()
+            except Exception as e:
+                logging.error("Could not reload the blacklist cache", exc_info=e)
+                delay = min(delay * 2, 300)
+
+    def _on_notification(self, connection, pid, channel, payload):
+        data = json.loads(payload)
+        user_id = int(data["id"])
+        if data["is_blacklisted"]:
+            # The reason doesn't fit in a notification, the user is blacklisted right away and it follows.
+            self.entries.setdefault(user_id, "No reason provided")
+            task = asyncio.get_running_loop().create_task(self._fetch_reason(user_id))
+            self._reason_tasks.add(task)
+            task.add_done_callback(self._reason_tasks.discard)
+        else:
+            self.entries.pop(user_id, None)
+
+    async def _fetch_reason(self, user_id: int):
+        try:
+            reason = await self.pool.fetchval(FETCH_BLACKLIST_REASON, user_id)
+        except Exception as e:
+            logging.warning(f"Could not fetch the blacklist reason of {user_id}: {e}")
+            return
+        # Unblacklisted meanwhile, by the time the query ran or since.
+        if reason is not None and user_id in self.entries:
+            self.entries[user_id] = reason
+
+    async def get(self, user_id: int):
+        """Returns the blacklist reason of the user or ``None`` if they aren't blacklisted."""
+        if self.loaded:
+            self.hits += 1
+            return self.entries.get(user_id)
+        self.misses += 1
+        return await self.pool.fetchval(FETCH_BLACKLIST_REASON, user_id)
@@ -0,0 +1,140 @@
+import asyncio
+import contextlib
+import logging
+import time
+
+import asyncpg
+
+from utils.metrics import Histogram
+
+
+class Query:
+    """
+    A fixed query issued by the bot, identified by its name in the metrics.
+
+    asyncpg prepares every statement server-side the first time a connection runs it and keeps it in the
+    connection's statement cache, so fixed queries are only parsed and planned once per connection as long
+    as the cache is large enough to hold all of them.
+    """
+
+    registry: dict[str, "Query"] = {}
+
+    def __init__(self, name: str, sql: str):
+        self.name = name
+        self.sql = sql
+        Query.registry[name] = self
+
+    def __repr__(self):
+        return f"<Query {self.name}>"
+
+
+class DatabasePool:
+    """
+    Thin wrapper around :class:`asyncpg.Pool` exposing the same query methods, recording the acquire wait time
+    and the latency of every query, grouped by :class:`Query` name.
+    """
+
+    def __init__(self, pool: asyncpg.Pool):
+        self._pool = pool
+        self.acquire_wait = Histogram()
+        self.query_latency: dict[str, Histogram] = {}
+        self.query_errors: dict[str, int] = {}
+
+    @classmethod
+    async def create(cls, conf, *, retries: int = 5) -> "DatabasePool":
+        delay = 1
+        for attempt in range(retries + 1):
+            try:
+                pool = await asyncpg.create_pool(
+                    user=conf.user,
+                    password=conf.password,
+                    database=conf.db,
+                    host=conf.host,
+                    port=conf.port,
+                    min_size=getattr(conf, "min_size", 2),
+                    max_size=getattr(conf, "max_size", 10),
+                    # Set to 0 when running behind pgbouncer in transaction mode.
+                    statement_cache_size=max(getattr(conf, "statement_cache_size", 100), 0),
+                    command_timeout=getattr(conf, "command_timeout", 10),
+                    max_inactive_connection_lifetime=getattr(conf, "max_inactive_connection_lifetime", 300),
+                )
+                return cls(pool)
+            except (OSError, asyncpg.PostgresError, asyncio.TimeoutError) as e:
+                if attempt == retries:
+                    raise
+                logging.warning(f"Could not create database pool ({e}), retrying in {delay}s "
+                                f"[{attempt + 1}/{retries}]")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    @property
+    def stats(self) -> dict:
+        size = self._pool.get_size()
+        idle = self._pool.get_idle_size()
+        return {
+            "size": size,
+            "idle": idle,
+            "in_use": size - idle,
+            "min_size": self._pool.get_min_size(),
+            "max_size": self._pool.get_max_size(),
+        }
+
+    def _observe(self, name: str, duration: float):
+        histogram = self.query_latency.get(name)
+        if histogram is None:
+            histogram = self.query_latency[name] = Histogram()
+        histogram.observe(duration)
+
+    async def acquire(self):
+        start = time.perf_counter()
+        connection = await self._pool.acquire()
+        self.acquire_wait.observe(time.perf_counter() - start)
+        return connection
+
+    async def release(self, connection):
+        await self._pool.release(connection)
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        connection = await self.acquire()
+        try:
+            yield connection
+        finally:
+            await self.release(connection)
+
+    @contextlib.asynccontextmanager
+    async def timed(self, query):
+        """Records the latency and errors of whatever runs inside under the query's name, e.g. a cursor."""
+        name = query.name if isinstance(query, Query) else "raw"
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.query_errors[name] = self.query_errors.get(name, 0) + 1
+            raise
+        finally:
+            self._observe(name, time.perf_counter() - start)
+
+    async def _run(self, method: str, query, *args, **kwargs):
+        async with self.connection() as connection:
+            async with self.timed(query):
+                sql = query.sql if isinstance(query, Query) else query
+                return await getattr(connection, method)(sql, *args, **kwargs)
+
+    async def execute(self, query, *args, **kwargs):
+        return await self._run("execute", query, *args, **kwargs)
+
+    async def executemany(self, query, args, **kwargs):
+        return await self._run("executemany", query, args, **kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        return await self._run("fetch", query, *args, **kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        return await self._run("fetchrow", query, *args, **kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        return await self._run("fetchval", query, *args, **kwargs)
+
+    async def close(self):
+        await self._pool.close()
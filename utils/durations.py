@@ -0,0 +1,189 @@
+"""
+Parsing of the subscription durations and expiration dates given to /register.
+
+Almost every input is a French relative duration ("1 semaine", "30 jours", "3 mois") or an explicit date
+("10 avril 2022", "10/04/2022"), those are handled by a compiled fast path whose results are cached.
+Anything else falls back to dateparser, which is slow and is therefore run in a thread by :func:`parse_async`.
+
+Expirations are in the future, so durations count forward and year-less dates fall on their next occurrence.
+Filters on past events (the /export bounds) parse with ``past=True``: durations count back and year-less dates
+fall on their last occurrence.
+"""
+import asyncio
+import calendar
+import datetime
+import functools
+import re
+import unicodedata
+import zoneinfo
+
+PARIS = zoneinfo.ZoneInfo("Europe/Paris")
+
+DATEPARSER_SETTINGS = {'TO_TIMEZONE': 'UTC', 'TIMEZONE': 'Europe/Paris', 'RETURN_AS_TIMEZONE_AWARE': True,
+                       'PREFER_DATES_FROM': 'future'}
+DATEPARSER_PAST_SETTINGS = {**DATEPARSER_SETTINGS, 'PREFER_DATES_FROM': 'past'}
+
+# Unit -> (months, seconds)
+UNITS = {}
+for _names, _value in (
+        (("minute", "minutes", "min", "mins"), (0, 60)),
+        (("heure", "heures", "h", "hour", "hours"), (0, 3600)),
+        (("jour", "jours", "j", "day", "days"), (0, 86400)),
+        (("semaine", "semaines", "sem", "week", "weeks"), (0, 7 * 86400)),
+        (("mois", "month", "months"), (1, 0)),
+        (("an", "ans", "annee", "annees", "year", "years"), (12, 0)),
+):
+    UNITS.update(dict.fromkeys(_names, _value))
+
+MONTHS = {
+    "janvier": 1, "janv": 1, "fevrier": 2, "fevr": 2, "fev": 2, "mars": 3, "avril": 4, "avr": 4, "mai": 5,
+    "juin": 6, "juillet": 7, "juil": 7, "aout": 8, "septembre": 9, "sept": 9, "octobre": 10, "oct": 10,
+    "novembre": 11, "nov": 11, "decembre": 12, "dec": 12,
+}
+
+# Longer inputs are rejected before any matching, nothing legitimate is that long (the modal caps it at 50).
+MAX_LENGTH = 50
+
+# An amount glued to its unit, "30j".
+GLUED_PART = re.compile(r"(\d+)([a-z]+)")
+TEXT_DATE = re.compile(r"(\d{1,2})(?:er)?\s+([a-z]+)\.?(?:\s+(\d{4}))?")
+NUMERIC_DATE = re.compile(r"(\d{1,2})[/.-](\d{1,2})(?:[/.-](\d{2}|\d{4}))?")
+ISO_DATE = re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2})")
+
+
+def normalize(value: str) -> str:
+    value = unicodedata.normalize("NFKD", value.lower()).encode("ascii", "ignore").decode()
+    return " ".join(value.split())
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_value(value: str):
+    """
+    Turns a normalized input into a spec that doesn't depend on the current time:
+    ``("delta", months, seconds)`` or ``("date", year or None, month, day)``. Returns ``None`` if the
+    input isn't handled by the fast path.
+    """
+    if (spec := compile_duration(value)) is not None:
+        return spec
+
+    if match := TEXT_DATE.fullmatch(value):
+        day, month, year = match.groups()
+        if month not in MONTHS:
+            return None
+        return "date", int(year) if year else None, MONTHS[month], int(day)
+
+    if match := NUMERIC_DATE.fullmatch(value):
+        # French order, day first.
+        day, month, year = match.groups()
+        if year is not None and len(year) == 2:
+            year = "20" + year
+        return "date", int(year) if year else None, int(month), int(day)
+
+    if match := ISO_DATE.fullmatch(value):
+        year, month, day = match.groups()
+        return "date", int(year), int(month), int(day)
+    return None
+
+
+def compile_duration(value: str):
+    """
+    Reads "1 mois et 2 jours" like inputs word by word rather than through a single regex, which would be
+    ambiguous (and backtrack exponentially) on runs of letters.
+    """
+    months = seconds = parts = 0
+    amount = None
+    joined = False
+    for word in value.replace(",", " ").split():
+        if amount is None:
+            if word == "et" and parts and not joined:
+                joined = True
+                continue
+            if word in ("un", "une"):
+                amount = 1
+                continue
+            if word.isdigit():
+                amount = int(word)
+                continue
+            match = GLUED_PART.fullmatch(word)
+            if match is None:
+                return None
+            amount, word = int(match.group(1)), match.group(2)
+        # "10 avril" starts like a duration too.
+        if word not in UNITS:
+            return None
+        unit_months, unit_seconds = UNITS[word]
+        months += amount * unit_months
+        seconds += amount * unit_seconds
+        amount = None
+        joined = False
+        parts += 1
+    if amount is not None or joined or not (months or seconds):
+        return None
+    return "delta", months, seconds
+
+
+def add_months(moment: datetime.datetime, months: int) -> datetime.datetime:
+    month_index = moment.month - 1 + months
+    year, month = moment.year + month_index // 12, month_index % 12 + 1
+    return moment.replace(year=year, month=month, day=min(moment.day, calendar.monthrange(year, month)[1]))
+
+
+def resolve(spec, now: datetime.datetime, past: bool = False):
+    if spec[0] == "delta":
+        _, months, seconds = spec
+        if past:
+            return add_months(now, -months) - datetime.timedelta(seconds=seconds)
+        return add_months(now, months) + datetime.timedelta(seconds=seconds)
+
+    _, year, month, day = spec
+    today = now.astimezone(PARIS).date()
+    try:
+        date = datetime.date(year or today.year, month, day)
+        # Like dateparser with PREFER_DATES_FROM='future' or 'past'.
+        if year is None and past and date > today:
+            date = date.replace(year=today.year - 1)
+        elif year is None and not past and date < today:
+            date = date.replace(year=today.year + 1)
+    except ValueError:
+        return None
+    # Explicit dates are given in Paris time, at midnight.
+    return datetime.datetime.combine(date, datetime.time(), PARIS).astimezone(datetime.timezone.utc)
+
+
+def parse_fast(value: str, now: datetime.datetime = None, past: bool = False):
+    """Parses the input through the fast path only, returns ``None`` if it can't."""
+    if len(value) > MAX_LENGTH:
+        return None
+    spec = compile_value(normalize(value))
+    if spec is None:
+        return None
+    return resolve(spec, now or datetime.datetime.now(datetime.timezone.utc), past)
+
+
+def parse_slow(value: str, past: bool = False):
+    import dateparser  # Slow to import, see `warm_up`.
+    return dateparser.parse(value, settings=DATEPARSER_PAST_SETTINGS if past else DATEPARSER_SETTINGS)
+
+
+def parse(value: str, now: datetime.datetime = None, past: bool = False):
+    """Returns the aware UTC datetime the input refers to, or ``None``. May block, see :func:`parse_async`."""
+    if len(value) > MAX_LENGTH:
+        return None
+    result = parse_fast(value, now, past)
+    if result is None:
+        result = parse_slow(value, past)
+    return result
+
+
+async def parse_async(value: str, past: bool = False):
+    if len(value) > MAX_LENGTH:
+        return None
+    result = parse_fast(value, past=past)
+    if result is None:
+        result = await asyncio.to_thread(parse_slow, value, past)
+    return result
+
+
+def warm_up():
+    """Imports dateparser and compiles its French data, meant to be run in a thread once the bot is ready."""
+    parse_slow("10 avril 2022")
@@ -0,0 +1,93 @@
+import asyncio
+import hashlib
+import io
+import logging
+import traceback
+
+import discord
+
+
+def fingerprint(error: BaseException) -> str:
+    """Identifies an error by its type and the frames it went through, ignoring its message."""
+    frames = traceback.extract_tb(error.__traceback__)
+    key = type(error).__qualname__ + "|".join(f"{f.filename}:{f.name}:{f.lineno}" for f in frames)
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+class _Report:
+    __slots__ = ("context", "traceback", "count", "first_seen", "last_seen")
+
+    def __init__(self, context: str, traceback_string: str):
+        self.context = context
+        self.traceback = traceback_string
+        self.count = 0
+        self.first_seen = self.last_seen = discord.utils.utcnow()
+
+
+class ErrorReporter:
+    """
+    Groups the unexpected errors by fingerprint and sends one summary per fingerprint to the error channel
+    every ``window`` seconds, so that an outage doesn't turn into hundreds of messages.
+    """
+
+    def __init__(self, bot, channel_id: int, window: float = 60):
+        self.bot = bot
+        self.channel_id = channel_id
+        self.window = window
+        self._reports: dict[str, _Report] = {}
+        self._task: asyncio.Task = None
+
+    def report(self, error: BaseException, context: str, traceback_string: str = None):
+        """Queues an error, never blocks: the report is sent by the next flush."""
+        key = fingerprint(error)
+        report = self._reports.get(key)
+        if report is None:
+            if traceback_string is None:
+                traceback_string = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+            report = self._reports[key] = _Report(context, traceback_string)
+        report.count += 1
+        report.last_seen = discord.utils.utcnow()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        await self.bot.wait_until_ready()
+        while True:
+            await asyncio.sleep(self.window)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error("Could not flush the error reports", exc_info=e)
+
+    async def flush(self):
+        if not self._reports:
+            return
+        reports, self._reports = self._reports, {}
+        # Only the cluster handling the support guild caches the channel, the others can still send to it.
+        error_channel = self.bot.get_partial_messageable(self.channel_id)
+        for key, report in reports.items():
+            await self._send(error_channel, key, report)
+
+    @staticmethod
+    async def _send(error_channel, key: str, report: _Report):
+        occurrences = f"occurrences: {report.count} - fingerprint: {key}"
+        if report.count > 1:
+            occurrences += f"\nfirst: {report.first_seen:%Y-%m-%d %H:%M:%S} - last: {report.last_seen:%H:%M:%S} UTC"
+        header = f"```yaml\n{report.context}\n{occurrences}``````py"
+        to_send = f"{header}\n{report.traceback}\n```"
+
+        try:
+            if len(to_send) < 2000:
+                await error_channel.send(to_send)
+            else:
+                await error_channel.send(f"{header}\n```",
+                                         file=discord.File(io.StringIO(report.traceback), filename='traceback.py'))
+        except discord.HTTPException as e:
+            logging.error(f"Could not send error report {key}", exc_info=e)
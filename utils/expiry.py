@@ -0,0 +1,112 @@
+import asyncio
+import datetime
+import heapq
+import logging
+import time
+
+from utils.database import Query
+
+# How far ahead we look when filling the heap, anything after that is picked up by the next refill.
+LOOKAHEAD = datetime.timedelta(hours=6)
+# Upper bound of rows kept in memory, the heap is refilled once it runs dry anyway.
+MAX_SCHEDULED = 5000
+
+FETCH_UPCOMING = Query("fetch_upcoming_expirations",
+                       "SELECT transaction, expire_at FROM subscribe "
+                       "WHERE user_id IS NOT NULL AND expire_at IS NOT NULL AND expire_at <= $1 "
+                       "ORDER BY expire_at LIMIT $2")
+
+DELETE_EXPIRED = Query("delete_expired_subscriptions",
+                       "DELETE FROM subscribe WHERE user_id IS NOT NULL AND expire_at <= $1 "
+                       "RETURNING transaction, user_id")
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class ExpiryScheduler:
+    """
+    Keeps the upcoming subscription expirations in a min-heap and sleeps until the next one is due.
+
+    Only rows whose ``expire_at`` falls within ``LOOKAHEAD`` are loaded (through the ``expire_at`` index),
+    expired rows are removed with a single ``DELETE ... RETURNING`` and the premium role is then taken back.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._heap: list[tuple[datetime.datetime, str]] = []
+        self._horizon: datetime.datetime = utcnow()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = self.bot.loop.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def schedule(self, transaction: str, expire_at: datetime.datetime):
+        """Registers a newly claimed subscription, waking the scheduler up if it expires sooner than anything known."""
+        if expire_at is None or expire_at > self._horizon:
+            return  # Will be loaded by the next refill.
+        heapq.heappush(self._heap, (expire_at, transaction))
+        if self._heap[0][1] == transaction:
+            self._wakeup.set()
+
+    async def _refill(self):
+        self._horizon = utcnow() + LOOKAHEAD
+        rows = await self.bot.pool.fetch(FETCH_UPCOMING, self._horizon, MAX_SCHEDULED)
+        self._heap = [(r["expire_at"], r["transaction"]) for r in rows]
+        heapq.heapify(self._heap)
+        if len(rows) == MAX_SCHEDULED:
+            # The heap is truncated, the horizon can't be trusted past its last element.
+            self._horizon = rows[-1]["expire_at"]
+
+    async def _expire(self, now: datetime.datetime):
+        while self._heap and self._heap[0][0] <= now:
+            heapq.heappop(self._heap)
+        rows = await self.bot.pool.fetch(DELETE_EXPIRED, now)
+        if not rows:
+            return
+        logging.info(f"{len(rows)} subscription(s) expired.")
+        self.bot.metrics.inc("akb_expired_subscriptions_total", len(rows))
+        members = [m for m in map(self.bot.server_object.get_member, {int(r["user_id"]) for r in rows}) if m]
+        result = await self.bot.role_mutator.remove_roles(members, self.bot.server_premium_role,
+                                                          reason="Éxpiration de l'abonnement")
+        if result.failed:
+            self.bot.metrics.inc("akb_role_mutation_failures_total", len(result.failed), source="expiry")
+            logging.warning(f"Could not remove the premium role of {len(result.failed)} expired member(s).")
+
+    async def _run(self):
+        await self.bot.wait_until_ready()
+        # Rows that expired while the bot was down are deleted right away, their members must be resolvable by then:
+        # wait for `on_ready_once` to resolve and chunk the premium guild (the member cache is lean otherwise).
+        while self.bot.server_premium_role is None or not self.bot.server_object.chunked:
+            await asyncio.sleep(5)
+        while not self.bot.is_closed():
+            try:
+                now = utcnow()
+                if now >= self._horizon:
+                    await self._refill()
+                if self._heap and self._heap[0][0] <= now:
+                    start = time.perf_counter()
+                    await self._expire(now)
+                    self.bot.metrics.observe("akb_expiry_cycle_seconds", time.perf_counter() - start)
+                    continue
+
+                deadline = self._heap[0][0] if self._heap else self._horizon
+                timeout = (min(deadline, self._horizon) - utcnow()).total_seconds()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("Expiry scheduler iteration failed", exc_info=e)
+                await asyncio.sleep(60)
@@ -0,0 +1,135 @@
+"""
+Logging that never blocks the event loop: records are put on a queue and formatted and written by a
+:class:`logging.handlers.QueueListener` thread, as one JSON object per line.
+
+Records can carry structured fields through ``extra`` (see :func:`interaction_fields`), and high-volume events can
+be sampled by tagging them with ``extra={"sample": "<event>"}``, only the configured fraction of them is kept.
+Warnings and errors are never sampled out.
+"""
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+import time
+
+TEXT_FORMAT = "[%(asctime)-15s] %(message)s"
+# Fraction of the records kept per sampled event.
+DEFAULT_SAMPLING = {"command": 0.1}
+# Attributes every LogRecord has, anything else was given through `extra`.
+RESERVED = frozenset(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime", "sample"}
+ANSI_ESCAPE = re.compile(r"\033\[[0-9;]*m")
+
+_listener: logging.handlers.QueueListener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, **static):
+        super().__init__()
+        # Added to every record, such as the cluster id.
+        self.static = static
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": ANSI_ESCAPE.sub("", record.getMessage()).strip(),
+            **self.static,
+        }
+        data.update((key, value) for key, value in record.__dict__.items() if key not in RESERVED)
+        if record.exc_info:
+            # The whole traceback in one field of one record.
+            data["traceback"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["traceback"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(getattr(record, "sample", None))
+        return rate is None or record.levelno >= logging.WARNING or random.random() < rate
+
+
+class LoopQueueHandler(logging.handlers.QueueHandler):
+    """
+    Unlike the stock handler, doesn't format the record before enqueuing it: the message and traceback are
+    formatted by the listener thread, off the event loop.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__)
+        # The arguments could be mutated before the listener gets to them.
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+
+def setup(level=logging.INFO, *, json_output: bool = True, sampling: dict[str, float] = None, **static):
+    """
+    Routes every record of the root logger through a queue to a stderr handler running in its own thread,
+    replacing the handlers set up before, e.g. in a forked process. ``static`` fields are added to every record.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter(**static) if json_output else logging.Formatter(TEXT_FORMAT))
+    records = queue.SimpleQueue()
+    handler = LoopQueueHandler(records)
+    handler.addFilter(SamplingFilter(DEFAULT_SAMPLING if sampling is None else sampling))
+
+    root = logging.getLogger()
+    for previous in root.handlers[:]:
+        root.removeHandler(previous)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.unregister(stop)
+    atexit.register(stop)
+    return _listener
+
+
+def setup_from_config(config, **static):
+    """:func:`setup` with the LOG_LEVEL, LOG_FORMAT ('json' or 'text') and LOG_SAMPLING of the private config."""
+    return setup(getattr(config, "LOG_LEVEL", logging.INFO),
+                 json_output=getattr(config, "LOG_FORMAT", "json") == "json",
+                 sampling=getattr(config, "LOG_SAMPLING", None), **static)
+
+
+def stop():
+    """Flushes the queued records, registered to run at exit."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def interaction_fields(interaction, command=None) -> dict:
+    """Structured fields describing an interaction, to be given as ``extra``."""
+    if command is not None:
+        name = getattr(command, "qualified_name", str(command))
+    else:
+        modal = interaction.extras.get("modal")
+        name = type(modal).__name__ if modal is not None else None
+    fields = {
+        "interaction": interaction.id,
+        "command": name,
+        "guild": interaction.guild_id,
+        "user": interaction.user.id,
+    }
+    started_at = interaction.extras.get("started_at")
+    if started_at is not None:
+        fields["latency_ms"] = round((time.perf_counter() - started_at) * 1000, 2)
+    return fields
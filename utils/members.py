@@ -0,0 +1,40 @@
+import time
+from collections import OrderedDict
+
+import discord
+
+
+class MemberResolver:
+    """
+    Resolves members by id: from the guild's cache first, then from a small LRU of fetched members,
+    and only then through the API. Members that aren't in the guild are remembered too.
+    """
+
+    def __init__(self, max_size: int = 512, ttl: float = 600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._cache: OrderedDict[tuple[int, int], tuple[float, discord.Member]] = OrderedDict()
+
+    def invalidate(self, guild_id: int, user_id: int):
+        self._cache.pop((guild_id, user_id), None)
+
+    async def get(self, guild: discord.Guild, user_id: int):
+        member = guild.get_member(user_id)
+        if member is not None:
+            return member
+
+        key = (guild.id, user_id)
+        entry = self._cache.get(key)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._cache.move_to_end(key)
+            return entry[1]
+
+        try:
+            member = await guild.fetch_member(user_id)
+        except discord.NotFound:
+            member = None
+        self._cache[key] = (time.monotonic(), member)
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return member
@@ -0,0 +1,155 @@
+import asyncio
+import bisect
+import logging
+import time
+
+from aiohttp import web
+
+from utils.pipeline import stage_stats
+
+# Latency buckets (in seconds) shared by every histogram.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Yields ``(upper bound, cumulative count)`` pairs, the last bound being ``+Inf``."""
+        total = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels.keys(), escaped)) + "}"
+
+
+class Metrics:
+    """
+    Collects counters, gauges and histograms and serves them in the Prometheus text format on ``/metrics``.
+
+    Metrics owned by other components (database pool, blacklist cache, modal stages, gateway latency) are
+    read when the endpoint is scraped, so recording them costs nothing on the hot path.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.counters: dict[str, dict[tuple, float]] = {}
+        self.histograms: dict[str, dict[tuple, Histogram]] = {}
+        self.loop_lag = 0.0
+        self._runner: web.AppRunner = None
+        self._lag_task: asyncio.Task = None
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = tuple(labels.items())
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = tuple(labels.items())
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+    async def start(self, host: str, port: int):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, host, port).start()
+        except OSError:
+            await self._runner.cleanup()
+            self._runner = None
+            raise
+        self._lag_task = asyncio.create_task(self._measure_loop_lag())
+        logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _measure_loop_lag(self, interval: float = 1.0):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lag = max(time.perf_counter() - start - interval, 0.0)
+            self.observe("akb_event_loop_lag_seconds", self.loop_lag)
+
+    async def _handle(self, request):
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+    def render(self) -> str:
+        lines = []
+
+        def gauge(name, value, **labels):
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+        def histogram(name, hist: Histogram, **labels):
+            for bound, count in hist.cumulative():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_labels({**labels, 'le': le})} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {hist.sum}")
+            lines.append(f"{name}_count{_labels(labels)} {hist.count}")
+
+        for name, series in self.counters.items():
+            lines.append(f"# TYPE {name} counter")
+            for key, value in series.items():
+                gauge(name, value, **dict(key))
+        for name, series in self.histograms.items():
+            lines.append(f"# TYPE {name} histogram")
+            for key, hist in series.items():
+                histogram(name, hist, **dict(key))
+
+        lines.append("# TYPE akb_gateway_latency_seconds gauge")
+        for shard_id, latency in self.bot.latencies:
+            if latency == latency:  # NaN until the first heartbeat.
+                gauge("akb_gateway_latency_seconds", latency, shard=shard_id)
+
+        pool = self.bot.pool
+        if pool is not None:
+            lines.append("# TYPE akb_db_pool_connections gauge")
+            stats = pool.stats
+            gauge("akb_db_pool_connections", stats["in_use"], state="in_use")
+            gauge("akb_db_pool_connections", stats["idle"], state="idle")
+            lines.append("# TYPE akb_db_acquire_wait_seconds histogram")
+            histogram("akb_db_acquire_wait_seconds", pool.acquire_wait)
+            lines.append("# TYPE akb_db_query_seconds histogram")
+            for name, hist in pool.query_latency.items():
+                histogram("akb_db_query_seconds", hist, query=name)
+            lines.append("# TYPE akb_db_query_errors_total counter")
+            for name, count in pool.query_errors.items():
+                gauge("akb_db_query_errors_total", count, query=name)
+
+        if self.bot.blacklist is not None:
+            lines.append("# TYPE akb_blacklist_cache_lookups_total counter")
+            gauge("akb_blacklist_cache_lookups_total", self.bot.blacklist.hits, result="hit")
+            gauge("akb_blacklist_cache_lookups_total", self.bot.blacklist.misses, result="miss")
+
+        lines.append("# TYPE akb_rate_limit_buckets gauge")
+        gauge("akb_rate_limit_buckets", len(self.bot.rate_limiter.buckets))
+
+        lines.append("# TYPE akb_modal_stage_seconds summary")
+        for (pipeline, stage), stats in stage_stats.items():
+            gauge("akb_modal_stage_seconds_sum", stats.total, modal=pipeline, stage=stage)
+            gauge("akb_modal_stage_seconds_count", stats.count, modal=pipeline, stage=stage)
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,211 @@
+"""
+Versioned schema of the bot's database.
+
+Pending migrations are applied in order from ``setup_hook``, each in its own transaction, and recorded in
+``schema_migrations``. A migration must never be edited once released, add a new one instead.
+
+``python -m utils.migrations check`` plans every :class:`~utils.database.Query` with sequential scans disabled
+and fails if any of them still scans a large table, meaning no index can serve it.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+
+from utils.database import Query
+
+# Arbitrary key of the advisory lock held while migrating, so that clusters starting together don't race.
+LOCK_KEY = 0x616B62
+
+CREATE_SCHEMA_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version integer PRIMARY KEY,
+    name text NOT NULL,
+    applied_at timestamptz NOT NULL DEFAULT now()
+)
+"""
+
+# Tables with fewer rows than this are scanned faster than through an index anyway.
+LARGE_TABLE = 10_000
+
+
+class Migration:
+    def __init__(self, version: int, name: str, sql: str):
+        self.version = version
+        self.name = name
+        self.sql = sql
+
+    def __repr__(self):
+        return f"<Migration {self.version:04d}_{self.name}>"
+
+
+MIGRATIONS = [
+    # The tables predate the migrations, existing databases are left as they are.
+    Migration(1, "initial", """
+    CREATE TABLE IF NOT EXISTS registered_user (
+        id bigint PRIMARY KEY,
+        name text,
+        is_blacklisted boolean DEFAULT FALSE,
+        reason text
+    );
+    CREATE TABLE IF NOT EXISTS subscribe (
+        transaction text PRIMARY KEY,
+        user_id bigint,
+        approved boolean NOT NULL DEFAULT FALSE,
+        registered_at timestamptz,
+        claimed_at timestamptz,
+        expire_at timestamptz
+    );
+    """),
+    # `transaction` and `registered_user.id` are already covered by their primary keys.
+    Migration(2, "indexes", """
+    CREATE INDEX IF NOT EXISTS registered_user_blacklisted_idx ON registered_user (id) WHERE is_blacklisted;
+    CREATE INDEX IF NOT EXISTS subscribe_user_id_idx ON subscribe (user_id);
+    CREATE INDEX IF NOT EXISTS subscribe_expire_at_idx ON subscribe (expire_at) WHERE user_id IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS subscribe_registered_at_idx ON subscribe (registered_at);
+    """),
+    # Sends the blacklist state of a user on every change so that every running bot can keep its cache in sync.
+    Migration(3, "blacklist_notify", """
+    CREATE OR REPLACE FUNCTION notify_registered_user_blacklist() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('registered_user_blacklist',
+                              json_build_object('id', OLD.id, 'is_blacklisted', false)::text);
+            RETURN OLD;
+        END IF;
+        IF TG_OP = 'INSERT' OR NEW.is_blacklisted IS DISTINCT FROM OLD.is_blacklisted
+                OR NEW.reason IS DISTINCT FROM OLD.reason THEN
+            PERFORM pg_notify('registered_user_blacklist', json_build_object(
+                'id', NEW.id, 'is_blacklisted', coalesce(NEW.is_blacklisted, false), 'reason', NEW.reason)::text);
+        END IF;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS registered_user_blacklist_notify ON registered_user;
+    CREATE TRIGGER registered_user_blacklist_notify
+        AFTER INSERT OR UPDATE OR DELETE ON registered_user
+        FOR EACH ROW EXECUTE FUNCTION notify_registered_user_blacklist();
+    """),
+    Migration(4, "dm_outbox", """
+    CREATE TABLE IF NOT EXISTS dm_outbox (
+        id bigserial PRIMARY KEY,
+        user_id bigint NOT NULL,
+        content text NOT NULL,
+        dedup_key text UNIQUE,
+        send_after timestamptz NOT NULL DEFAULT now(),
+        attempts integer NOT NULL DEFAULT 0,
+        last_error text,
+        sent_at timestamptz
+    );
+    CREATE INDEX IF NOT EXISTS dm_outbox_pending_idx ON dm_outbox (send_after) WHERE sent_at IS NULL;
+    CREATE INDEX IF NOT EXISTS dm_outbox_sent_at_idx ON dm_outbox (sent_at) WHERE sent_at IS NOT NULL;
+    """),
+    # NOTIFY payloads are capped under 8000 bytes and the reason isn't: a long one made the UPDATE itself fail.
+    # The reason is now fetched by the listener.
+    Migration(5, "blacklist_notify_without_reason", """
+    CREATE OR REPLACE FUNCTION notify_registered_user_blacklist() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('registered_user_blacklist',
+                              json_build_object('id', OLD.id, 'is_blacklisted', false)::text);
+            RETURN OLD;
+        END IF;
+        IF TG_OP = 'INSERT' OR NEW.is_blacklisted IS DISTINCT FROM OLD.is_blacklisted
+                OR NEW.reason IS DISTINCT FROM OLD.reason THEN
+            PERFORM pg_notify('registered_user_blacklist', json_build_object(
+                'id', NEW.id, 'is_blacklisted', coalesce(NEW.is_blacklisted, false))::text);
+        END IF;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+    """),
+]
+
+assert [m.version for m in MIGRATIONS] == list(range(1, len(MIGRATIONS) + 1)), "Migrations must be numbered in order"
+
+
+async def migrate(pool) -> list[Migration]:
+    """Applies the pending migrations and returns them."""
+    applied = []
+    async with pool.connection() as connection:
+        await connection.execute("SELECT pg_advisory_lock($1)", LOCK_KEY)
+        try:
+            await connection.execute(CREATE_SCHEMA_TABLE)
+            done = {r["version"] for r in await connection.fetch("SELECT version FROM schema_migrations")}
+            for migration in MIGRATIONS:
+                if migration.version in done:
+                    continue
+                async with connection.transaction():
+                    await connection.execute(migration.sql)
+                    await connection.execute("INSERT INTO schema_migrations(version, name) VALUES ($1, $2)",
+                                             migration.version, migration.name)
+                logging.info(f"Applied migration {migration.version:04d}_{migration.name}.")
+                applied.append(migration)
+        finally:
+            await connection.execute("SELECT pg_advisory_unlock($1)", LOCK_KEY)
+    return applied
+
+
+def walk(plan: dict):
+    yield plan
+    for child in plan.get("Plans", ()):
+        yield from walk(child)
+
+
+async def check(pool, min_rows: int = LARGE_TABLE) -> list[str]:
+    """
+    Returns the queries that sequentially scan a table of at least ``min_rows`` rows (as estimated by the last
+    ANALYZE). Sequential scans are disabled while planning, so the planner only falls back to one when no index
+    applies, whatever the size of the tables in the database it runs against.
+    """
+    problems = []
+    async with pool.connection() as connection:
+        if connection.get_server_version().major < 16:
+            raise RuntimeError("Planning queries without their parameters needs EXPLAIN (GENERIC_PLAN), Postgres 16+")
+        sizes = {r["relname"]: r["reltuples"] for r in await connection.fetch(
+            "SELECT relname, reltuples FROM pg_class WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace")}
+        async with connection.transaction():
+            await connection.execute("SET LOCAL enable_seqscan = off")
+            for query in Query.registry.values():
+                plan = json.loads(await connection.fetchval(f"EXPLAIN (FORMAT JSON, GENERIC_PLAN) {query.sql}"))
+                for node in walk(plan[0]["Plan"]):
+                    relation = node.get("Relation Name")
+                    # reltuples is -1 until the table is first vacuumed or analyzed.
+                    rows = max(sizes.get(relation, 0), 0)
+                    if node["Node Type"] == "Seq Scan" and (min_rows <= 0 or rows >= min_rows):
+                        problems.append(f"{query.name}: sequential scan on {relation} (~{rows:.0f} rows)")
+    return problems
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("migrate", "check"))
+    parser.add_argument("--min-rows", type=int, default=LARGE_TABLE,
+                        help="Ignore the tables smaller than this, 0 to check every table of a dev database")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)-15s] %(message)s")
+
+    from private.config import DB_CONF
+    from utils.database import DatabasePool
+    # Importing these registers every fixed query of the bot.
+    import utils.blacklist, utils.expiry, utils.modals, utils.outbox, utils.reconcile, utils.subscriptions  # noqa
+
+    pool = await DatabasePool.create(DB_CONF)
+    try:
+        applied = await migrate(pool)
+        logging.info(f"{len(applied)} migration(s) applied, schema at version {MIGRATIONS[-1].version}.")
+        if args.command == "check":
+            problems = await check(pool, args.min_rows)
+            for problem in problems:
+                logging.error(problem)
+            logging.info(f"Checked {len(Query.registry)} queries, {len(problems)} problem(s).")
+            if problems:
+                sys.exit(1)
+    finally:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,17 +1,88 @@
+import time
+
 import discord
-import asyncpg
-import datetime
-import dateparser
+from discord import app_commands
+
+from utils import durations
+from utils.database import Query
+from utils.pipeline import StageTimer
+from utils.subscriptions import register_transactions
 
 NOT_APPROVED = "Votre numéro de transaction n'a pas encore été ajouté dans la base de donnée, votre inscription est " \
                "donc pour l'instant en attente. Le bot vous contactera quand elle aura eté validée (merci de ne pas " \
                "quitter le serveur). "
 
+# Registers the user and claims the transaction in a single statement, returning one of 'pending', 'claimed' or
+# 'taken' along with the expiration date. The data-modifying CTEs all see the table as it was before the statement:
+# a freshly inserted transaction is always pending, and only an approved transaction that isn't bound to anyone (or is
+# bound to the user but not claimed yet) can be claimed, its duration starting from the claim. The status is only
+# 'claimed' if the row ends up bound to the user.
+CLAIM_SUBSCRIPTION = Query("claim_subscription", """
+WITH registered AS (
+    INSERT INTO registered_user(id, name) VALUES ($1, $2)
+    ON CONFLICT (id) DO UPDATE SET name = $2
+), inserted AS (
+    INSERT INTO subscribe(transaction, user_id, approved, registered_at) VALUES ($3, $1, FALSE, now())
+    ON CONFLICT (transaction) DO NOTHING
+    RETURNING transaction
+), claimed AS (
+    UPDATE subscribe SET user_id = $1, claimed_at = now(), expire_at = now() + (expire_at - registered_at)
+    WHERE transaction = $3 AND approved AND expire_at IS NOT NULL
+      AND (user_id IS NULL OR (user_id = $1 AND claimed_at IS NULL))
+    RETURNING expire_at
+)
+SELECT CASE
+           WHEN EXISTS(SELECT 1 FROM inserted) THEN 'pending'
+           WHEN EXISTS(SELECT 1 FROM claimed) THEN 'claimed'
+           WHEN s.transaction IS NULL THEN 'pending'
+           WHEN s.user_id IS NOT NULL AND s.user_id <> $1 THEN 'taken'
+           WHEN NOT s.approved OR s.expire_at IS NULL THEN 'pending'
+           WHEN s.user_id = $1 THEN 'claimed'
+           -- Unbound in our snapshot but not claimable any more: someone claimed it concurrently.
+           ELSE 'taken'
+       END AS status,
+       coalesce((SELECT expire_at FROM claimed), s.expire_at) AS expire_at
+FROM (SELECT 1) AS one
+LEFT JOIN subscribe s ON s.transaction = $3
+""")
+
 
 class BaseModal(discord.ui.Modal):
-    async def on_error(self, error: Exception, interaction) -> None:
+    """
+    Acknowledges the submission right away and runs :meth:`process` in a background task,
+    its return value is then sent through the interaction's followup webhook.
+    """
+
+    async def on_error(self, interaction, error: Exception) -> None:
         await interaction.client.tree.on_error(interaction, interaction.command, error)
 
+    async def on_submit(self, interaction) -> None:
+        interaction.extras["started_at"] = time.perf_counter()
+        interaction.extras["modal"] = self
+        # Modal submissions don't go through the command tree's interaction check.
+        try:
+            interaction.client.rate_limiter.hit(type(self).__name__, interaction.user.id)
+        except app_commands.CommandOnCooldown as e:
+            await self.on_error(interaction, e)
+            return
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        interaction.client.create_background_task(self._run(interaction))
+
+    async def _run(self, interaction):
+        timer = StageTimer(type(self).__name__)
+        try:
+            message = await self.process(interaction, timer)
+            async with timer.stage("followup"):
+                await interaction.followup.send(message, ephemeral=True)
+            interaction.client.record_command(interaction, None, "ok")
+        except Exception as e:
+            await self.on_error(interaction, e)
+        finally:
+            timer.finish()
+
+    async def process(self, interaction, timer: StageTimer) -> str:
+        raise NotImplementedError
+
 
 class SubscribeModal(BaseModal):
     transaction_id = discord.ui.TextInput(
@@ -24,39 +95,24 @@ class SubscribeModal(BaseModal):
     def __init__(self, **kwargs):
         super().__init__(title="Formulaire d'abonnement", **kwargs)
 
-    async def on_submit(self, interaction) -> None:
+    async def process(self, interaction, timer) -> str:
         cleaned_transaction_id = self.transaction_id.value.replace(" ", "")
-        await interaction.client.pool.execute(
-            "INSERT INTO Registered_user(id,name) VALUES($1,$2) ON CONFLICT(id) DO UPDATE SET name=$2",
-            interaction.user.id, str(interaction.user.name))
-        try:
-            await interaction.client.pool.execute(
-                "INSERT INTO subscribe (transaction,user_id,approved,registered_at) VALUES($1,$2,$3,$4)",
-                cleaned_transaction_id, interaction.user.id, False, datetime.datetime.utcnow())
-            return await interaction.response.send_message(NOT_APPROVED,
-                                                           ephemeral=True)
-        except asyncpg.exceptions.UniqueViolationError:
-            results = await interaction.client.pool.fetchrow(
-                "SELECT * FROM subscribe WHERE transaction=$1", cleaned_transaction_id)
-            if results["user_id"] is not None and int(results["user_id"]) != interaction.user.id:
-                await interaction.response.send_message("Un abonnement a deja été enregistré avec ce numéro de "
-                                                        "transaction, votre demande a donc été annulée.", ephemeral=True)
-            else:
-                if not results["approved"] or results["expire_at"] is None:
-                    return await interaction.response.send_message(NOT_APPROVED, ephemeral=True)
-                if results["claimed_at"] is None:
-                    claimed_at = datetime.datetime.utcnow()
-                    new_expire_at = claimed_at + (results['expire_at'] - results['registered_at'])
-                    await interaction.client.pool.execute("UPDATE subscribe SET user_id=$1,expire_at=$2,claimed_at=$3",
-                                                          interaction.user.id, new_expire_at, claimed_at)
-                else:
-                    new_expire_at = results["expire_at"]
-                await interaction.user.add_roles(
-                    interaction.client.server_premium_role, reason="Abonnement automatique")
-                message_ = f"Votre abonnement a bien été enregistré et est valable jusqu'au " \
-                           + \
-                           discord.utils.format_dt(new_expire_at) + "."
-                await interaction.response.send_message(message_, ephemeral=True)
+        async with timer.stage("database"):
+            result = await interaction.client.pool.fetchrow(
+                CLAIM_SUBSCRIPTION, interaction.user.id, str(interaction.user.name), cleaned_transaction_id)
+        if result["status"] == "taken":
+            return "Un abonnement a deja été enregistré avec ce numéro de transaction, votre demande a donc été " \
+                   "annulée."
+        if result["status"] == "pending":
+            return NOT_APPROVED
+        if interaction.client.expiry_scheduler:
+            interaction.client.expiry_scheduler.schedule(cleaned_transaction_id, result["expire_at"])
+        async with timer.stage("roles"):
+            await interaction.client.role_mutator.submit(
+                interaction.user, interaction.client.server_premium_role, add=True, reason="Abonnement automatique")
+        return f"Votre abonnement a bien été enregistré et est valable jusqu'au " \
+               + \
+               discord.utils.format_dt(result["expire_at"]) + "."
 
 
 class RegisterModal(BaseModal):
@@ -76,25 +132,17 @@ class RegisterModal(BaseModal):
     def __init__(self, **kwargs):
         super().__init__(title="Enregistrement d'une nouvelle transaction", **kwargs)
 
-    async def on_submit(self, interaction) -> None:
+    async def process(self, interaction, timer) -> str:
         cleaned_transaction_id = self.transaction_id.value.replace(" ", "")
-        expire_at = dateparser.parse(
-            self.expire_at.value,
-            settings={'TO_TIMEZONE': 'UTC', 'TIMEZONE': 'Europe/Paris', 'RETURN_AS_TIMEZONE_AWARE': True,
-                      'PREFER_DATES_FROM': 'future'},
-        )
+        async with timer.stage("parse"):
+            expire_at = await durations.parse_async(self.expire_at.value)
         if expire_at is None:
-            return await interaction.response.send_message("Je n'ai pas pu comprendre la date d'éxpiration, merci de "
-                                                           "réessayer avec une autre valeur")
-        user_id = await interaction.client.pool.fetchval(
-            "INSERT INTO subscribe(transaction,approved,expire_at,registered_at) VALUES ($1,$2,$3,$4) ON CONFLICT(transaction) DO UPDATE SET approved=$2,expire_at=$3,claimed_at=$4 RETURNING user_id",
-            cleaned_transaction_id, True, expire_at, datetime.datetime.utcnow())
-        if user_id:
-            member = discord.utils.get(interaction.client.server_object.members, id=user_id)
-            if not member:
-                await interaction.client.pool.execute("UPDATE subscribe SET user_id=$1,claimed_at=$1", None)
-            else:
-                await member.add_roles(interaction.client.server_premium_role, reason="Abonnement automatique")
-                await interaction.client.send_safe_dm(member,
-                                                      f"Votre abonnement a été approuvé, vous pouvez donc bénéficier de celui-ci jusqu'au {discord.utils.format_dt(expire_at)}.")
-        await interaction.response.send_message("L'abonnement a été enregistré avec succès !", ephemeral=True)
+            return "Je n'ai pas pu comprendre la date d'éxpiration, merci de réessayer avec une autre valeur"
+        result = await register_transactions(interaction.client, [(cleaned_transaction_id, expire_at)], timer)
+        if result.unbound:
+            return "L'abonnement a été enregistré, mais le membre qui l'avait réclamé a quitté le serveur : la " \
+                   "transaction peut de nouveau être réclamée."
+        if result.failed:
+            return "L'abonnement a été enregistré, mais je n'ai pas pu donner le role au membre qui l'a réclamé " \
+                   "(il le recevra lors de la prochaine synchronisation)."
+        return "L'abonnement a été enregistré avec succès !"
@@ -0,0 +1,169 @@
+import asyncio
+import datetime
+import logging
+
+import discord
+
+from utils.database import Query
+
+# Messages claimed per round trip, and sent at the same time.
+BATCH_SIZE = 50
+CONCURRENCY = 5
+# DMs sent per second at most, Discord flags bots opening DMs too fast.
+RATE = 5
+# A claimed message is sent again if it wasn't acknowledged in time (the bot died mid-way).
+LEASE = datetime.timedelta(minutes=5)
+MAX_ATTEMPTS = 8
+# How long the worker sleeps when the outbox is empty, `wake` cuts it short.
+POLL_INTERVAL = 30
+# Sent messages are kept that long, so that the dedup keys still apply.
+RETENTION = datetime.timedelta(days=30)
+
+ENQUEUE_DMS = Query(
+    "enqueue_dms",
+    "INSERT INTO dm_outbox(user_id, content, dedup_key, send_after) "
+    "SELECT u, c, k, coalesce(a, now()) FROM unnest($1::bigint[], $2::text[], $3::text[], $4::timestamptz[]) "
+    "AS v(u, c, k, a) ON CONFLICT (dedup_key) DO NOTHING")
+
+# Pushing `send_after` by the lease hides the claimed rows from the other workers until they're acknowledged.
+CLAIM_DMS = Query("claim_dms", """
+UPDATE dm_outbox SET send_after = now() + $2::interval, attempts = attempts + 1
+WHERE id IN (
+    SELECT id FROM dm_outbox WHERE sent_at IS NULL AND send_after <= now() AND attempts < $3
+    ORDER BY send_after LIMIT $1 FOR UPDATE SKIP LOCKED
+)
+RETURNING id, user_id, content, attempts
+""")
+
+MARK_SENT = Query("mark_dms_sent",
+                  "UPDATE dm_outbox SET sent_at = now(), last_error = NULL WHERE id = ANY($1::bigint[])")
+
+# Exponential backoff from a minute up to 6 hours, the messages that can't ever be delivered are given up on.
+MARK_FAILED = Query("mark_dms_failed", """
+UPDATE dm_outbox o SET last_error = v.e,
+                       attempts = CASE WHEN v.g THEN $4 ELSE o.attempts END,
+                       send_after = now() + make_interval(secs => least(60 * power(2, o.attempts - 1), 21600))
+FROM unnest($1::bigint[], $2::text[], $3::bool[]) AS v(i, e, g)
+WHERE o.id = v.i
+""")
+
+PURGE_SENT = Query("purge_sent_dms", "DELETE FROM dm_outbox WHERE sent_at < now() - $1::interval")
+
+
+class Outbox:
+    """
+    DMs are written to the ``dm_outbox`` table and delivered by a background worker, so that commands don't wait
+    on them and nothing is lost when a send fails or the bot restarts.
+
+    The worker claims the due messages in batches and sends them a few at a time, paced to ``RATE`` per second.
+    Failed sends are retried with an exponential backoff, and a ``dedup_key`` makes enqueuing idempotent.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task = None
+        self._next_slot = 0.0
+        self._purged_at = 0.0
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = self.bot.loop.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def enqueue(self, messages):
+        """
+        Queues ``(user_id, content, dedup_key, send_after)`` tuples in a single round trip, ``dedup_key`` and
+        ``send_after`` may be ``None``. Messages whose key was already queued are ignored.
+        """
+        messages = list(messages)
+        if not messages:
+            return
+        user_ids, contents, keys, send_after = zip(*messages)
+        await self.bot.pool.execute(ENQUEUE_DMS, list(user_ids), list(contents), list(keys), list(send_after))
+        self.wake()
+
+    async def _pace(self):
+        now = self.bot.loop.time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + 1 / RATE
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _send(self, row, semaphore):
+        """Returns ``None`` once sent, else the error and whether it's worth retrying."""
+        async with semaphore:
+            user_id = row["user_id"]
+            try:
+                # Resolving the member may call Discord too, its errors are handled like the send's.
+                user = self.bot.get_user(user_id) or await self.bot.members.get(self.bot.server_object, user_id)
+                if user is None:
+                    return "Unknown member", False
+                await self._pace()
+                await user.send(row["content"])
+            except (discord.Forbidden, discord.NotFound) as e:
+                # DMs closed, or the user is gone: retrying won't help.
+                return f"{type(e).__name__}: {e}", False
+            except Exception as e:
+                return f"{type(e).__name__}: {e}", row["attempts"] < MAX_ATTEMPTS
+            return None
+
+    async def _deliver(self, rows):
+        semaphore = asyncio.Semaphore(CONCURRENCY)
+        results = await asyncio.gather(*(self._send(row, semaphore) for row in rows), return_exceptions=True)
+        sent, failed = [], []
+        for row, result in zip(rows, results):
+            if result is None:
+                sent.append(row["id"])
+            elif isinstance(result, BaseException):
+                failed.append((row["id"], f"{type(result).__name__}: {result}", row["attempts"] < MAX_ATTEMPTS))
+            else:
+                failed.append((row["id"], *result))
+
+        if sent:
+            await self.bot.pool.execute(MARK_SENT, sent)
+            self.bot.metrics.inc("akb_dms_total", len(sent), status="sent")
+        if failed:
+            ids, errors, give_up = zip(*((i, e, not retry) for i, e, retry in failed))
+            await self.bot.pool.execute(MARK_FAILED, list(ids), list(errors), list(give_up), MAX_ATTEMPTS)
+            dropped = sum(give_up)
+            self.bot.metrics.inc("akb_dms_total", len(failed) - dropped, status="retried")
+            self.bot.metrics.inc("akb_dms_total", dropped, status="dropped")
+            logging.warning(f"{len(failed)} DM(s) could not be sent, {dropped} of them dropped.")
+
+    async def _purge(self):
+        if self.bot.loop.time() - self._purged_at > 3600:
+            self._purged_at = self.bot.loop.time()
+            await self.bot.pool.execute(PURGE_SENT, RETENTION)
+
+    async def _run(self):
+        await self.bot.wait_until_ready()
+        # The members are resolved through the premium guild, set by `on_ready_once`.
+        while self.bot.server_object is None:
+            await asyncio.sleep(5)
+        while not self.bot.is_closed():
+            try:
+                # Cleared before claiming, a message queued meanwhile wakes the next wait up right away.
+                self._wakeup.clear()
+                rows = await self.bot.pool.fetch(CLAIM_DMS, BATCH_SIZE, LEASE, MAX_ATTEMPTS)
+                if rows:
+                    await self._deliver(rows)
+                    continue
+
+                await self._purge()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("DM outbox iteration failed", exc_info=e)
+                await asyncio.sleep(60)
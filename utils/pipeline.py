@@ -0,0 +1,51 @@
+import time
+import logging
+import contextlib
+from collections import defaultdict
+
+
+class StageStats:
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration: float):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+# (pipeline name, stage name) -> aggregated durations, in seconds.
+stage_stats: dict[tuple[str, str], StageStats] = defaultdict(StageStats)
+
+
+class StageTimer:
+    """Records how long each stage of a pipeline (database, roles, DM...) takes."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started_at = time.perf_counter()
+        self.stages: list[tuple[str, float]] = []
+
+    @contextlib.asynccontextmanager
+    async def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.stages.append((name, duration))
+            stage_stats[(self.name, name)].add(duration)
+
+    def finish(self):
+        total = time.perf_counter() - self.started_at
+        stage_stats[(self.name, "total")].add(total)
+        details = ", ".join(f"{name}={duration * 1000:.1f}ms" for name, duration in self.stages)
+        logging.debug(f"{self.name} took {total * 1000:.1f}ms ({details})")
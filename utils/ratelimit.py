@@ -0,0 +1,91 @@
+import collections
+import time
+
+from discord import app_commands
+
+# Command or modal name -> (uses, per seconds). Overridden by RATE_LIMITS and GLOBAL_RATE_LIMITS in the config.
+DEFAULT_RATE_LIMITS = {
+    "subscribe": (3, 60),
+    "SubscribeModal": (3, 60),
+}
+DEFAULT_GLOBAL_RATE_LIMITS = {
+    "SubscribeModal": (20, 1),
+}
+
+
+class TokenBucket:
+    __slots__ = ("cooldown", "tokens", "updated")
+
+    def __init__(self, cooldown: app_commands.Cooldown, now: float):
+        self.cooldown = cooldown
+        self.tokens = float(cooldown.rate)
+        self.updated = now
+
+    def refill(self, now: float):
+        rate, per = self.cooldown.rate, self.cooldown.per
+        self.tokens = min(rate, self.tokens + (now - self.updated) * rate / per)
+        self.updated = now
+
+    def retry_after(self) -> float:
+        """Seconds until a token is available, 0 if one is, the bucket must have been refilled first."""
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) * self.cooldown.per / self.cooldown.rate
+
+    def idle(self, now: float) -> bool:
+        """A full bucket is the same as no bucket at all, so it can be forgotten."""
+        elapsed = now - self.updated
+        return self.tokens + elapsed * self.cooldown.rate / self.cooldown.per >= self.cooldown.rate
+
+
+class RateLimiter:
+    """
+    Per user and global token buckets, checked before anything reaches the database.
+
+    Each check is O(1): the per user buckets live in an ordered dict moved to the end on use, so the least
+    recently used ones are at the front and evicted as soon as they are full again, or when over ``max_buckets``.
+    """
+
+    def __init__(self, limits: dict = None, global_limits: dict = None, max_buckets: int = 10_000):
+        self.limits = {name: app_commands.Cooldown(*limit) for name, limit in (limits or {}).items()}
+        self.global_buckets = {name: TokenBucket(app_commands.Cooldown(*limit), time.monotonic())
+                               for name, limit in (global_limits or {}).items()}
+        self.max_buckets = max_buckets
+        self.buckets: collections.OrderedDict[tuple[str, int], TokenBucket] = collections.OrderedDict()
+
+    def _evict(self, now: float):
+        # Leaves room for the bucket about to be created.
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if len(self.buckets) < self.max_buckets and not bucket.idle(now):
+                break
+            del self.buckets[key]
+
+    def hit(self, name: str, user_id: int):
+        """Takes a token from the user's and the global bucket of ``name``, raises CommandOnCooldown if either is empty."""
+        cooldown = self.limits.get(name)
+        global_bucket = self.global_buckets.get(name)
+        if cooldown is None and global_bucket is None:
+            return
+        now = time.monotonic()
+
+        bucket = None
+        if cooldown is not None:
+            self._evict(now)
+            bucket = self.buckets.get((name, user_id))
+            if bucket is None:
+                bucket = self.buckets[(name, user_id)] = TokenBucket(cooldown, now)
+            else:
+                self.buckets.move_to_end((name, user_id))
+
+        # Nothing is taken unless both buckets have a token.
+        for candidate in (bucket, global_bucket):
+            if candidate is None:
+                continue
+            candidate.refill(now)
+            retry_after = candidate.retry_after()
+            if retry_after:
+                raise app_commands.CommandOnCooldown(candidate.cooldown, retry_after)
+        for candidate in (bucket, global_bucket):
+            if candidate is not None:
+                candidate.tokens -= 1
@@ -0,0 +1,55 @@
+import logging
+
+from utils.database import Query
+
+FETCH_ACTIVE_SUBSCRIBERS = Query(
+    "fetch_active_subscribers",
+    "SELECT DISTINCT user_id FROM subscribe WHERE user_id IS NOT NULL AND approved AND expire_at > now()")
+
+IS_ACTIVE_SUBSCRIBER = Query(
+    "is_active_subscriber",
+    "SELECT EXISTS(SELECT 1 FROM subscribe WHERE user_id=$1 AND approved AND expire_at > now())")
+
+
+class Reconciler:
+    """
+    Brings the premium role back in line with the subscribe table: one query for the active subscribers,
+    a set difference with the role's members, and role calls only for the difference.
+    """
+
+    def __init__(self, bot, exempt_ids=()):
+        self.bot = bot
+        # Members keeping the role whatever the table says (staff, partners...).
+        self.exempt_ids = set(exempt_ids)
+
+    async def reconcile(self) -> tuple[int, int]:
+        """Returns how many members were granted and stripped of the role."""
+        guild, role = self.bot.server_object, self.bot.server_premium_role
+        rows = await self.bot.pool.fetch(FETCH_ACTIVE_SUBSCRIBERS)
+        active = {int(r["user_id"]) for r in rows}
+        holders = {m.id for m in role.members}
+
+        to_add = [m for m in map(guild.get_member, active - holders) if m is not None and not m.bot]
+        to_remove = [guild.get_member(i) for i in holders - active - self.exempt_ids]
+        to_remove = [m for m in to_remove if m is not None and not m.bot]
+
+        added = await self.bot.role_mutator.add_roles(to_add, role, reason="Synchronisation des abonnements")
+        removed = await self.bot.role_mutator.remove_roles(to_remove, role, reason="Synchronisation des abonnements")
+        failed = len(added.failed) + len(removed.failed)
+        self.bot.metrics.inc("akb_reconciled_members_total", len(added.succeeded), action="add")
+        self.bot.metrics.inc("akb_reconciled_members_total", len(removed.succeeded), action="remove")
+        if failed:
+            self.bot.metrics.inc("akb_role_mutation_failures_total", failed, source="reconcile")
+        logging.info(f"Reconciled {len(active)} active subscription(s) with {len(holders)} role holder(s): "
+                     f"{len(added.succeeded)} added, {len(removed.succeeded)} removed, {failed} failed.")
+        return len(added.succeeded), len(removed.succeeded)
+
+    async def reconcile_member(self, member) -> bool:
+        """Gives the role back to a member who rejoined with an active subscription."""
+        role = self.bot.server_premium_role
+        if member.bot or role in member.roles:
+            return False
+        if not await self.bot.pool.fetchval(IS_ACTIVE_SUBSCRIBER, member.id):
+            return False
+        await self.bot.role_mutator.submit(member, role, add=True, reason="Abonnement automatique")
+        return True
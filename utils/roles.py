@@ -0,0 +1,139 @@
+import asyncio
+import logging
+
+import discord
+
+
+class RoleMutationSuperseded(Exception):
+    """The mutation was replaced by the opposite one before being applied."""
+
+
+class BatchResult:
+    """Outcome of a batch of role mutations, failures are mapped by member id."""
+
+    def __init__(self):
+        self.succeeded: list[int] = []
+        self.failed: dict[int, Exception] = {}
+
+    def __repr__(self):
+        return f"<BatchResult succeeded={len(self.succeeded)} failed={len(self.failed)}>"
+
+
+class _RoleOperation:
+    __slots__ = ("guild_id", "member_id", "role_id", "add", "reason", "future")
+
+    def __init__(self, guild_id, member_id, role_id, add, reason, future):
+        self.guild_id = guild_id
+        self.member_id = member_id
+        self.role_id = role_id
+        self.add = add
+        self.reason = reason
+        self.future = future
+
+
+class RoleMutator:
+    """
+    Shared queue of role additions/removals processed by a bounded pool of workers.
+
+    Requests go straight through the bot's HTTP client, which already waits on Discord's per-route rate-limit
+    buckets, so the throughput is bounded by those buckets instead of serial awaits. A mutation queued for a
+    member/role pair that is still waiting is merged into the previous one instead of issuing a second request,
+    or replaces it if it goes the other way.
+    """
+
+    def __init__(self, bot, workers: int = 8, retries: int = 3):
+        self.bot = bot
+        self.workers = workers
+        self.retries = retries
+        self._queue: asyncio.Queue = None
+        self._pending: dict[tuple[int, int], _RoleOperation] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for operation in self._pending.values():
+            if not operation.future.done():
+                operation.future.cancel()
+        self._pending.clear()
+
+    def submit(self, member: discord.abc.Snowflake, role: discord.Role, *, add: bool, reason: str = None):
+        """Queues a single mutation and returns a future resolved once it has been applied."""
+        key = (member.id, role.id)
+        operation = self._pending.get(key)
+        if operation is not None:
+            # Not picked up by a worker yet: the same request is merged into it, the opposite one replaces it
+            # (the latest request wins) and its callers are told theirs never ran.
+            if operation.add == add:
+                operation.reason = reason
+                return operation.future
+            if not operation.future.done():
+                operation.future.set_exception(RoleMutationSuperseded(
+                    f"Role {'addition' if operation.add else 'removal'} superseded for member {member.id}"))
+            enqueue = False
+        else:
+            enqueue = True
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = _RoleOperation(role.guild.id, member.id, role.id, add, reason, future)
+        if enqueue:
+            self._queue.put_nowait(key)
+        return future
+
+    async def _apply(self, members, role, *, add, reason) -> BatchResult:
+        members = list({m.id: m for m in members}.values())
+        futures = [self.submit(member, role, add=add, reason=reason) for member in members]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        batch = BatchResult()
+        for member, result in zip(members, results):
+            if isinstance(result, Exception):
+                batch.failed[member.id] = result
+            else:
+                batch.succeeded.append(member.id)
+        return batch
+
+    async def add_roles(self, members, role: discord.Role, *, reason: str = None) -> BatchResult:
+        return await self._apply(members, role, add=True, reason=reason)
+
+    async def remove_roles(self, members, role: discord.Role, *, reason: str = None) -> BatchResult:
+        return await self._apply(members, role, add=False, reason=reason)
+
+    async def _execute(self, operation: _RoleOperation):
+        method = self.bot.http.add_role if operation.add else self.bot.http.remove_role
+        for attempt in range(self.retries + 1):
+            try:
+                return await method(operation.guild_id, operation.member_id, operation.role_id, reason=operation.reason)
+            except discord.RateLimited as e:
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(e.retry_after)
+            except discord.HTTPException as e:
+                # 4xx errors (missing member, missing permissions...) won't get better by retrying.
+                if e.status < 500 or attempt == self.retries:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+
+    async def _worker(self):
+        while True:
+            key = await self._queue.get()
+            operation = self._pending.pop(key, None)
+            if operation is None:
+                continue
+            try:
+                await self._execute(operation)
+            except asyncio.CancelledError:
+                operation.future.cancel()
+                raise
+            except Exception as e:
+                logging.warning(f"Role mutation failed for member {operation.member_id}: {e}")
+                if not operation.future.done():
+                    operation.future.set_exception(e)
+            else:
+                if not operation.future.done():
+                    operation.future.set_result(None)
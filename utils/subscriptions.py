@@ -0,0 +1,216 @@
+import asyncio
+import contextlib
+import csv
+import datetime
+import gzip
+import io
+
+import asyncpg
+import discord
+
+from utils.database import Query
+
+REGISTER_TRANSACTIONS = Query(
+    "register_transactions",
+    "INSERT INTO subscribe(transaction,approved,expire_at,registered_at) "
+    "SELECT t, TRUE, e, now() FROM unnest($1::text[], $2::timestamptz[]) AS v(t, e) "
+    "ON CONFLICT(transaction) DO UPDATE SET approved=TRUE,expire_at=EXCLUDED.expire_at,"
+    # Only a transaction bound to a user counts as claimed, an unbound one starts over from its re-registration.
+    "claimed_at=CASE WHEN subscribe.user_id IS NULL THEN NULL ELSE EXCLUDED.registered_at END,"
+    "registered_at=CASE WHEN subscribe.user_id IS NULL THEN EXCLUDED.registered_at ELSE subscribe.registered_at END "
+    "RETURNING transaction, user_id, expire_at")
+
+UNBIND_TRANSACTIONS = Query(
+    "unbind_transactions",
+    "UPDATE subscribe SET user_id=NULL,claimed_at=NULL WHERE transaction = ANY($1::text[])")
+
+# How long before their expiration the members are reminded to renew their subscription.
+REMINDER_BEFORE = datetime.timedelta(days=3)
+
+# Queues the reminders falling due within $3, keyed on the expiration so that a renewed subscription gets a new one.
+# Subscriptions shorter than the reminder delay don't get any.
+ENQUEUE_EXPIRY_REMINDERS = Query(
+    "enqueue_expiry_reminders",
+    "INSERT INTO dm_outbox(user_id, content, dedup_key, send_after) "
+    "SELECT user_id, $2 || ' <t:' || extract(epoch FROM expire_at)::bigint || ':F>.', "
+    "'reminder:' || transaction || ':' || extract(epoch FROM expire_at)::bigint, "
+    "greatest(expire_at - $1::interval, now()) "
+    "FROM subscribe WHERE user_id IS NOT NULL AND approved AND expire_at > now() "
+    "AND expire_at <= now() + $3::interval + $1::interval "
+    "AND expire_at - coalesce(claimed_at, registered_at) > $1::interval "
+    "ON CONFLICT (dedup_key) DO NOTHING")
+
+
+class RegistrationResult:
+    def __init__(self):
+        self.registered = 0
+        self.granted: list[tuple[asyncpg.Record, discord.Member]] = []
+        self.unbound: list[str] = []
+        self.failed: dict[int, Exception] = {}
+
+
+async def register_transactions(bot, entries, timer=None) -> RegistrationResult:
+    """
+    Approves many ``(transaction, expire_at)`` pairs at once: a single upsert, then the premium role is granted
+    and the approval DM queued in the outbox for the members that had already claimed their transaction.
+    Transactions claimed by users who left the server are released so that they can be claimed again.
+    """
+    result = RegistrationResult()
+    entries = dict(entries)  # The last occurrence of a transaction wins, a row can't be upserted twice.
+    if not entries:
+        return result
+
+    async with stage(timer, "database"):
+        rows = await bot.pool.fetch(REGISTER_TRANSACTIONS, list(entries.keys()), list(entries.values()))
+    result.registered = len(rows)
+
+    claimed = [r for r in rows if r["user_id"]]
+    if not claimed:
+        return result
+
+    async with stage(timer, "member"):
+        members = await asyncio.gather(*(bot.members.get(bot.server_object, r["user_id"]) for r in claimed),
+                                       return_exceptions=True)
+    bound = []
+    for row, member in zip(claimed, members):
+        if member is None:
+            # Only a member known to have left (NotFound) releases the transaction.
+            result.unbound.append(row["transaction"])
+            continue
+        if bot.expiry_scheduler:
+            bot.expiry_scheduler.schedule(row["transaction"], row["expire_at"])
+        if isinstance(member, Exception):
+            # Still bound, the reconciler grants the role once the member can be resolved.
+            result.failed[row["user_id"]] = member
+        else:
+            bound.append((row, member))
+
+    if result.unbound:
+        async with stage(timer, "database"):
+            await bot.pool.execute(UNBIND_TRANSACTIONS, result.unbound)
+    if not bound:
+        return result
+
+    async with stage(timer, "roles"):
+        batch = await bot.role_mutator.add_roles([m for _, m in bound], bot.server_premium_role,
+                                                 reason="Abonnement automatique")
+    result.failed.update(batch.failed)
+    result.granted = [(row, m) for row, m in bound if m.id not in batch.failed]
+
+    async with stage(timer, "outbox"):
+        await bot.outbox.enqueue(
+            (member.id, f"Votre abonnement a été approuvé, vous pouvez donc bénéficier de celui-ci "
+                        f"jusqu'au {discord.utils.format_dt(row['expire_at'])}.",
+             f"approved:{row['transaction']}:{int(row['expire_at'].timestamp())}", None)
+            for row, member in result.granted)
+    return result
+
+
+async def enqueue_expiry_reminders(bot, lookahead: datetime.timedelta) -> str:
+    """Queues the reminders due within ``lookahead`` into the DM outbox, see :data:`REMINDER_BEFORE`."""
+    status = await bot.pool.execute(
+        ENQUEUE_EXPIRY_REMINDERS, REMINDER_BEFORE,
+        "Votre abonnement arrive bientôt à expiration, pensez à le renouveler. Il prendra fin le", lookahead)
+    bot.outbox.wake()
+    return status
+
+
+def terminate_sql(columns, operation: str = "AND") -> str:
+    """Deletes the subscriptions matching ``column=$n`` for each column, combined with ``operation``."""
+    condition = f" {operation} ".join(f"{column}=${i}" for i, column in enumerate(columns, 1))
+    return f"DELETE FROM subscribe WHERE {condition} RETURNING *"
+
+
+TERMINATE_BY_TRANSACTION = Query("terminate_by_transaction", terminate_sql(["transaction"]))
+TERMINATE_BY_USER = Query("terminate_by_user", terminate_sql(["user_id"]))
+TERMINATE_BOTH = Query("terminate_both", terminate_sql(["transaction", "user_id"], "AND"))
+TERMINATE_EITHER = Query("terminate_either", terminate_sql(["transaction", "user_id"], "OR"))
+
+# Every filter /terminate can build, the order of the columns is the order of the parameters.
+TERMINATE_QUERIES = {
+    (("transaction",), "AND"): TERMINATE_BY_TRANSACTION,
+    (("transaction",), "OR"): TERMINATE_BY_TRANSACTION,
+    (("user_id",), "AND"): TERMINATE_BY_USER,
+    (("user_id",), "OR"): TERMINATE_BY_USER,
+    (("transaction", "user_id"), "AND"): TERMINATE_BOTH,
+    (("transaction", "user_id"), "OR"): TERMINATE_EITHER,
+}
+
+
+def terminate_query(columns, operation: str = "AND") -> Query:
+    """The registered query deleting the subscriptions matching ``column=$n`` for each column."""
+    return TERMINATE_QUERIES[tuple(columns), operation]
+
+
+def stage(timer, name):
+    return timer.stage(name) if timer is not None else contextlib.nullcontext()
+
+
+# Status of a subscription as shown in the export, `status` can be pushed down through the matching predicate.
+STATUSES = {
+    "en attente": "NOT approved",
+    "non réclamé": "approved AND user_id IS NULL",
+    "actif": "approved AND user_id IS NOT NULL AND expire_at > now()",
+    "expiré": "approved AND user_id IS NOT NULL AND expire_at <= now()",
+}
+STATUS_CASE = "CASE " + " ".join(f"WHEN {predicate} THEN '{name}'" for name, predicate in STATUSES.items()) + " END"
+
+EXPORT_COLUMNS = ("transaction", "user_id", "approved", "registered_at", "claimed_at", "expire_at", "status")
+# Rows fetched per round trip from the server-side cursor.
+EXPORT_BATCH_SIZE = 2000
+
+
+def export_sql(status: str = None, start: bool = False, end: bool = False) -> str:
+    """The export query, with ``registered_at`` bounds as parameters in order when ``start`` and ``end`` are set."""
+    conditions = [f"({STATUSES[status]})"] if status is not None else []
+    bounds = [operator for operator, enabled in ((">=", start), ("<", end)) if enabled]
+    conditions += [f"registered_at {operator} ${i}" for i, operator in enumerate(bounds, 1)]
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return f"SELECT {', '.join(EXPORT_COLUMNS[:-1])}, {STATUS_CASE} AS status FROM subscribe {where} " \
+           f"ORDER BY registered_at"
+
+
+# Name of each status in the query names.
+STATUS_SLUGS = {
+    None: "all", "en attente": "pending", "non réclamé": "unclaimed", "actif": "active", "expiré": "expired",
+}
+
+# One registered query per combination of filters, so that `python -m utils.migrations check` plans exactly what runs.
+EXPORT_QUERIES = {
+    (status, start, end): Query(
+        f"export_{slug}_subscriptions" + ("_since" if start else "") + ("_until" if end else ""),
+        export_sql(status, start, end))
+    for status, slug in STATUS_SLUGS.items() for start in (False, True) for end in (False, True)
+}
+
+
+async def export_subscriptions(bot, file, *, status: str = None, start=None, end=None) -> int:
+    """
+    Streams the subscribe table, filtered on SQL side, as a gzip compressed CSV into ``file`` and returns the
+    number of rows. Rows go through a server-side cursor and are compressed in a thread, batch per batch,
+    so memory stays flat whatever the size of the table.
+    """
+    args = [value for value in (start, end) if value is not None]
+    query = EXPORT_QUERIES[status, start is not None, end is not None]
+
+    count = 0
+    with gzip.GzipFile(fileobj=file, mode="wb") as compressed:
+        text = io.TextIOWrapper(compressed, encoding="utf-8", newline="")
+        writer = csv.writer(text)
+        writer.writerow(EXPORT_COLUMNS)
+        async with bot.pool.connection() as connection, bot.pool.timed(query):
+            async with connection.transaction(readonly=True):
+                cursor = await connection.cursor(query.sql, *args)
+                while rows := await cursor.fetch(EXPORT_BATCH_SIZE):
+                    count += len(rows)
+                    await asyncio.to_thread(_write_rows, writer, text, rows)
+        text.flush()
+        text.detach()
+    return count
+
+
+def _write_rows(writer, text, rows):
+    for row in rows:
+        writer.writerow(["" if value is None else value.isoformat() if hasattr(value, "isoformat") else value
+                         for value in row.values()])
+    text.flush()
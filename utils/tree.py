@@ -1,5 +1,5 @@
 import math
-import humanize
+import time
 
 import discord
 from discord import app_commands
@@ -19,6 +19,7 @@ class CustomCommandTree(app_commands.CommandTree):
         embed = discord.Embed(colour=interaction.client.colour)
         if isinstance(error, app_commands.CommandInvokeError):
             error = error.original
+        interaction.client.record_command(interaction, command, type(error).__name__)
 
         if isinstance(error, app_commands.errors.CommandNotFound):
             embed.title = "🛑 Commande Introuvable"
@@ -34,6 +35,7 @@ class CustomCommandTree(app_commands.CommandTree):
                 await interaction.client.send_interaction_error_message(interaction, embed=embed)
 
             elif isinstance(error, app_commands.CommandOnCooldown):
+                import humanize  # Only needed here, not worth slowing the startup down.
                 _message = f"Cette commande est en cooldown, Merci de réessayer dans {humanize.time.precisedelta(math.ceil(error.retry_after))}. "
                 embed.title = "🛑 Commande En Cooldown"
                 embed.description = _message
@@ -79,7 +81,14 @@ class CustomCommandTree(app_commands.CommandTree):
             await interaction.client.send_unexpected_error(interaction, command, error)
 
     async def interaction_check(self, interaction) -> bool:
-        for check in interaction.client.default_checks:
-            if await check(interaction) is False:
-                return False
-        return True
+        start = interaction.extras["started_at"] = time.perf_counter()
+        try:
+            # Throttled before any check, those may hit the database.
+            if interaction.command is not None and interaction.type is discord.InteractionType.application_command:
+                interaction.client.rate_limiter.hit(interaction.command.qualified_name, interaction.user.id)
+            for check in interaction.client.default_checks:
+                if await check(interaction) is False:
+                    return False
+            return True
+        finally:
+            interaction.client.metrics.observe("akb_interaction_check_seconds", time.perf_counter() - start)